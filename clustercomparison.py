@@ -33,7 +33,7 @@ for d, times in KEY_DATES.items():
         # kicluster.plot_clusters(sm, filtered_data, envelope=True, nplots=NCLUSTERS)
 
         # Record cluster participation
-        cp[f'{d} {i.split("_")[1]}'] = sm[0]['Battery position']
+        cp[f'{d} {i.split("_")[1]}'] = sm['Battery position']
 
 
 # %% Contribution ratio of elements to capacity test clusters by refresh clusters
@@ -4,16 +4,40 @@ This code provides a framework for querying and analyzing data from influxdb
 
 # %% Import modules
 import os
+import json
+import time
+import asyncio
+import contextlib
+import concurrent.futures
 import pandas as pd
 
 from influxdb import DataFrameClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
+import kidata
+
 
 # --- Define functions
+def query_bounds(date):
+    '''Returns the time condition of a query covering one day from date,
+    or the previous 1-hour if date is None
+    '''
+    if date == None:
+        query = "time > now() - 1h"
+
+    else:
+        dt = pd.to_datetime(date)
+        start = f"'{dt.isoformat()}Z'"
+        stop = f"'{(dt+pd.DateOffset(days=1)).isoformat()}Z'"
+        query = f"time > {start} and time < {stop}"
+
+    return query
+
+
 def query_str(batt, str_no=1, date=None, meas='cell'):
     '''Returns a query string to call using dbclient.query() given inputs
     battery position, string number and date.
@@ -31,18 +55,6 @@ def query_str(batt, str_no=1, date=None, meas='cell'):
     date: query date. Default is None, and returns the previous 1-hour
     of data.
     '''
-    def query_bounds(date):
-        if date == None:
-            query = "time > now() - 1h"
-
-        else:
-            dt = pd.to_datetime(date)
-            start = f"'{dt.isoformat()}Z'"
-            stop = f"'{(dt+pd.DateOffset(days=1)).isoformat()}Z'"
-            query = f"time > {start} and time < {stop}"
-
-        return query
-
     dates = query_bounds(date)
     batt_pos = '("pos"' + f"='{batt}')"
     batt_str = '("sid"' + f"='{str_no}')"
@@ -65,13 +77,29 @@ def runquery(client, batt, str_no, meas, date=None):
     return str_df
 
 
-def querysample(start, stop, save=False, batt=1, str_no=1, meas='cell'):
-    # --- Plot Vc of a single battery between given dates
-    for d in pd.date_range(start, stop):
-        # Query db
-        db_query = query_str(batt, str_no, date=d)
-        str_df = dbclient.query(db_query)
+def querysample(start, stop, save=False, batt=1, str_no=1, meas='cell',
+                n_out=None, method='minmax', url=None, **kwargs):
+    '''
+    Plot Vc of a single battery between given dates
+
+    n_out: total points to plot over all days, see kidata.downsample().
+    Default is None, and uses two points per pixel of the plot width.
 
+    url: query every day at once with query_many() from this server (see
+    influx_url()), passing it kwargs. Default is None, and queries one day
+    at a time with dbclient.
+    '''
+    days = pd.date_range(start, stop)
+    ax = plt.gca()
+    n = max((n_out or 2*int(ax.bbox.width)) // len(days), 4)
+
+    db_queries = [query_str(batt, str_no, date=d) for d in days]
+    if url is not None:
+        results = query_many(db_queries, url, **kwargs)
+    else:
+        results = (dbclient.query(q) for q in db_queries)
+
+    for str_df in results:
         try:
             assert len(str_df) > 0
         except AssertionError:
@@ -83,7 +111,7 @@ def querysample(start, stop, save=False, batt=1, str_no=1, meas='cell'):
         # Dealing with the timezone conversion
         matplotlib.rcParams['timezone'] = 'Etc/GMT-11'
 
-        ax = str_df.Vc.plot()
+        ax = kidata.downsample(str_df.Vc, n, method).plot(ax=ax)
         ax.set_ylabel('Battery Voltage (V)')
         ax.xaxis.set_major_locator(mdates.DayLocator())
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%d %b'))
@@ -97,45 +125,274 @@ def querysample(start, stop, save=False, batt=1, str_no=1, meas='cell'):
     plt.show()
 
 
-def export_db(meas):
+def query_str_batch(batts, str_no=1, date=None, meas='cell', field='Vc'):
+    '''Returns a single query string for several batteries in one string,
+    grouped so that each battery comes back as its own series.
+
+    Parameters
+    ----------
+    batts: list of battery positions
+
+    field: field to select. Selecting one field rather than * keeps
+    responses small.
     '''
-    Query db and save data from all batteries as csv
+    batt_pos = ' or '.join('"pos"' + f"='{batt}'" for batt in batts)
+    batt_str = '("sid"' + f"='{str_no}')"
+
+    condlist = [query_bounds(date), f'({batt_pos})', batt_str]
+    conds = ' and '.join(condlist)
+
+    return f'SELECT "{field}" FROM {meas} WHERE {conds} GROUP BY "pos" limit 50000'
+
+
+def query_retry(client, db_query, retries=3, backoff=1.):
+    '''
+    Runs client.query(), retrying with exponential backoff when the server
+    errors or the connection fails or times out.
     '''
-    # --- Setup query for all batteries in all strings
-    mydir = r'C:\Users\lawrence.chan\Desktop\ki_data'
-    os.chdir(mydir)
-    dates = ['2019/05/01']
-    strings = [1, 2, 3]
+    for attempt in range(retries):
+        try:
+            return client.query(db_query)
 
-    for date in dates[-1:]:
+        except (OSError, InfluxDBServerError):
+            # requests' connection and timeout errors are OSErrors
+            if attempt == retries - 1:
+                raise
+            time.sleep(backoff * 2**attempt)
 
-        for str_no in strings:
 
-            query_out = pd.DataFrame()
+def export_string(client, str_no, date, meas='cell', field='Vc',
+                  batts=range(1, 481), batch_size=60, max_workers=8,
+                  retries=3, timeout=None):
+    '''
+    Query one field of every battery in a string over one day and return
+    a df with time index and battery columns.
+
+    Batteries are queried in batches of batch_size using GROUP BY "pos",
+    and batches run concurrently over max_workers threads.
+
+    Parameters
+    ----------
+    client: influxdb's DataFrameClient class, or any object with an
+    equivalent query() method
+
+    timeout: seconds to wait for all batches before raising
+    concurrent.futures.TimeoutError. Queued batches are cancelled, and
+    batches already running are left to finish in the background. Default
+    is None, and waits forever.
+    '''
+    batts = list(batts)
+    batches = [batts[i:i+batch_size] for i in range(0, len(batts), batch_size)]
+
+    series = {}
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+    try:
+        futures = [pool.submit(query_retry, client,
+                               query_str_batch(b, str_no, date, meas, field),
+                               retries)
+                   for b in batches]
+
+        for future in concurrent.futures.as_completed(futures, timeout):
+            _collect_batts(series, future.result(), field)
+
+    finally:
+        # without waiting, so that a timeout or error returns straight away
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return _assemble_string(series)
+
+
+def _collect_batts(series, result, field):
+    for key, df in result.items():
+        # grouped results are keyed by (meas, (('pos', '1'),))
+        batt = int(dict(key[1])['pos'])
+
+        # rounded per battery, so that samples a few ms apart share a row
+        series[batt] = df[field].set_axis(pd.to_datetime(df.index).round('1s'))
 
-            print(f'Querying string {str_no}: {date}')
-            for batt in range(1, 481):
-                print(f'String {str_no}, battery no.: {batt}')
-                db_query = query_str(batt=batt, str_no=str_no, date=date)
-                str_df = dbclient.query(db_query)
 
-                try:
-                    assert len(str_df) > 0
-                except AssertionError:
-                    print('No data')
-                    continue
+def _assemble_string(series):
+    if len(series) == 0:
+        return pd.DataFrame()
 
-                str_df = str_df[meas][['Vc']]
-                str_df.columns = [batt]
-                str_df.index = pd.to_datetime(str_df.index).round('1s')
-                str_df.index = str_df.index + pd.DateOffset(hours=10)
+    # assemble the wide frame in one pass
+    str_df = pd.concat([series[b] for b in sorted(series)],
+                       axis=1, keys=sorted(series), sort=False)
+    str_df.index = str_df.index + pd.DateOffset(hours=10)
+    str_df.index = str_df.index.tz_convert(None)
 
-                query_out = pd.concat([query_out, str_df], axis=1, sort=False)
+    return str_df
+
+
+# --- Asyncio queries over the InfluxDB HTTP API, so that many queries
+# overlap their network latency. aiohttp is imported when first used.
+def influx_url(host='172.20.2.52', port=8089, ssl=False):
+    '''Returns the url of the query endpoint of an InfluxDB server'''
+    return f"{'https' if ssl else 'http'}://{host}:{port}/query"
+
+
+async def _fetch(session, url, params, timeout):
+    # With chunked=true the response is one json object per line, each
+    # holding part of a series, which are parsed as they arrive
+    import aiohttp
+
+    parts = {}
+
+    def parse(line):
+        if not line.strip():
+            return
+        chunk = json.loads(line)
+        if 'error' in chunk:
+            raise InfluxDBClientError(chunk['error'])
+
+        for result in chunk.get('results', []):
+            if 'error' in result:
+                raise InfluxDBClientError(result['error'])
+
+            for s in result.get('series', []):
+                # keyed like DataFrameClient.query()
+                key = s['name']
+                if s.get('tags'):
+                    key = (s['name'], tuple(sorted(s['tags'].items())))
+                parts.setdefault(key, []).append(
+                    pd.DataFrame(s['values'], columns=s['columns']))
+
+    async with session.get(url, params=params,
+                           timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        if resp.status >= 500:
+            raise InfluxDBServerError(await resp.text())
+        if resp.status >= 400:
+            raise InfluxDBClientError(await resp.text(), resp.status)
+
+        buffer = b''
+        async for data in resp.content.iter_any():
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                parse(line)
+        parse(buffer)
+
+    frames = {}
+    for key, dfs in parts.items():
+        df = pd.concat(dfs, ignore_index=True)
+        df.index = pd.to_datetime(df.pop('time'), unit='ns', utc=True)
+        df.index.name = None
+        frames[key] = df
+
+    return frames
+
+
+async def query_async(session, url, db_query, database='smc', timeout=30,
+                      retries=3, backoff=1., chunk_size=10000,
+                      semaphore=None):
+    '''
+    Runs one query and returns a dictionary of dataframes, as
+    DataFrameClient.query(). Retries with exponential backoff when the
+    server errors, or the connection fails or times out.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession, shared by all queries
+
+    timeout: seconds allowed for each attempt
+
+    chunk_size: points per chunk of the streamed response
+
+    semaphore: asyncio.Semaphore held while a request is in flight, to
+    bound the number of concurrent queries
+    '''
+    import aiohttp
+
+    params = {'db': database, 'q': db_query, 'epoch': 'ns',
+              'chunked': 'true', 'chunk_size': str(chunk_size)}
+
+    for attempt in range(retries):
+        try:
+            async with semaphore or contextlib.nullcontext():
+                return await _fetch(session, url, params, timeout)
+
+        except (asyncio.TimeoutError, aiohttp.ClientError, InfluxDBServerError):
+            if attempt == retries - 1:
+                raise
+            await asyncio.sleep(backoff * 2**attempt)
+
+
+async def query_many_async(db_queries, url=None, database='smc',
+                           user=os.environ.get('influxQueryUser'),
+                           password=os.environ.get('influxQueryPass'),
+                           max_concurrency=8, **kwargs):
+    '''
+    Runs queries concurrently over one pooled session and returns their
+    results in order, see query_async().
+
+    max_concurrency: maximum number of queries, and connections, in flight
+
+    kwargs are passed to query_async()
+    '''
+    import aiohttp
+
+    url = influx_url() if url is None else url
+    auth = aiohttp.BasicAuth(user, password or '') if user else None
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, auth=auth) as session:
+        return await asyncio.gather(*(
+            query_async(session, url, q, database, semaphore=semaphore, **kwargs)
+            for q in db_queries))
+
+
+def query_many(db_queries, url=None, **kwargs):
+    '''
+    Blocking wrapper of query_many_async(). In a notebook or other running
+    event loop, await query_many_async() instead.
+    '''
+    return asyncio.run(query_many_async(db_queries, url, **kwargs))
+
+
+def export_string_async(str_no, date, meas='cell', field='Vc',
+                        batts=range(1, 481), batch_size=60, url=None,
+                        **kwargs):
+    '''
+    As export_string(), but with the batches queried concurrently with
+    query_many() instead of over threads with a blocking client.
+
+    kwargs are passed to query_many(), e.g. max_concurrency or timeout
+    '''
+    batts = list(batts)
+    batches = [batts[i:i+batch_size] for i in range(0, len(batts), batch_size)]
+
+    results = query_many([query_str_batch(b, str_no, date, meas, field)
+                          for b in batches], url, **kwargs)
+
+    series = {}
+    for result in results:
+        _collect_batts(series, result, field)
+
+    return _assemble_string(series)
+
+
+def export_db(meas, client=None, dates=('2019/05/01',), strings=(1, 2, 3),
+              mydir=r'C:\Users\lawrence.chan\Desktop\ki_data', **kwargs):
+    '''
+    Query db and save data from all batteries as csv
+
+    kwargs are passed to export_string()
+    '''
+    if client is None:
+        client = dbclient
+
+    for date in dates:
+
+        for str_no in strings:
+            print(f'Querying string {str_no}: {date}')
+            query_out = export_string(client, str_no, date, meas, **kwargs)
 
-            query_out.index = query_out.index.tz_convert(None)
+            if len(query_out) == 0:
+                print('No data')
+                continue
 
             sv_date = pd.to_datetime(date).strftime('%Y-%m-%d')
-            query_out.to_csv(f'{mydir}\{sv_date}-string {str_no}.csv')
+            query_out.to_csv(os.path.join(mydir, f'{sv_date}-string {str_no}.csv'))
 
     print('Complete')
 
@@ -0,0 +1,191 @@
+'''
+Batch clustering of ki_data backup files, for scheduled runs over a whole
+archive.
+
+Files are found with kidata.index_kidata(), and each (date, string) job is
+trimmed to an event window, resampled and clustered in a process pool. The
+cluster summary of each job is written to the output folder, with a report
+of every job in batch report.csv.
+
+Usage:
+    python kibatch.py C:/ki_data --start 2019-03-26 --stop 2019-03-27 \\
+        --strings 1 2 3 --window 11:00 23:40 --nclusters 2
+'''
+
+import os
+import time
+import argparse
+import concurrent.futures
+
+import pandas as pd
+
+import kidata
+import kicluster
+
+
+def event_window(date, window=None):
+    '''
+    Returns the (start, stop) timestamps of a daily event window on date.
+    A window that stops before it starts ends on the following day.
+
+    window: ('HH:MM', 'HH:MM'). Default is None, and uses the whole day.
+    '''
+    day = pd.Timestamp(date)
+    if window is None:
+        return day, day + pd.DateOffset(days=1) - pd.Timedelta(1)
+
+    start = day + pd.Timedelta(f'{window[0]}:00')
+    stop = day + pd.Timedelta(f'{window[1]}:00')
+    if stop <= start:
+        stop += pd.DateOffset(days=1)
+
+    return start, stop
+
+
+def make_jobs(index, start=None, stop=None, strings=None, window=None):
+    '''
+    Returns a list of (date, string, files, start, stop) jobs from an index
+    of ki_data files, one per date and string with data
+
+    start, stop: first and last dates to run. Default is None, and leaves
+    that side open.
+
+    strings: strings to run. Default is None, and runs every string.
+    '''
+    select = pd.Series(True, index=index.index)
+    if start is not None:
+        select &= index['date'] >= pd.Timestamp(start).strftime('%Y-%m-%d')
+    if stop is not None:
+        select &= index['date'] <= pd.Timestamp(stop).strftime('%Y-%m-%d')
+    if strings is not None:
+        select &= index['string'].isin(strings)
+
+    jobs = []
+    for (date, string), _ in index[select].groupby(['date', 'string']):
+        t0, t1 = event_window(date, window)
+
+        # a window past midnight also needs the next day's files
+        days = pd.date_range(t0.normalize(), t1.normalize()).strftime('%Y-%m-%d')
+        files = index.loc[index['date'].isin(days) &
+                          (index['string'] == string), 'file'].tolist()
+
+        jobs.append((date, string, files, t0, t1))
+
+    return jobs
+
+
+def run_job(date, string, files, start, stop, nclusters=2, method='ward',
+            metric='euclidean', engine='scipy', resample='10min', out_dir='.'):
+    '''
+    Clusters one string over an event window, writes the cluster summary
+    to out_dir and returns a row of the batch report
+    '''
+    t = time.perf_counter()
+
+    data = pd.concat(kidata.iter_kidata_csv(files, start, stop))
+    data = data.dropna(axis=1, how='all').dropna(axis=0, how='any')
+    if resample:
+        data = data.resample(resample).mean().dropna(axis=0, how='any')
+
+    sm = kicluster.cluster_summary(data, nclusters, method=method,
+                                   metric=metric, engine=engine)
+
+    out = os.path.join(out_dir, f'{date}_String {string}.json')
+    sm.to_json(out, orient='records', indent=2)
+
+    return {'date': date,
+            'string': string,
+            'No. Cells': data.shape[1],
+            'No. Samples': data.shape[0],
+            'No. Elements': sm['No. Elements'].tolist(),
+            'output': out,
+            'error': None,
+            'Seconds': time.perf_counter() - t}
+
+
+def run_batch(root, start=None, stop=None, strings=None, window=None,
+              out_dir='kibatch', max_workers=None, **kwargs):
+    '''
+    Runs run_job() for every date and string under root, and returns the
+    batch report as a df with one row per job. A failed job is recorded in
+    the error column instead of stopping the batch.
+
+    Parameters
+    ----------
+    window: daily event window, see event_window()
+
+    max_workers: number of worker processes. Default is None, and uses the
+    number of processors. 1 runs in this process.
+
+    kwargs: passed to run_job(), e.g. nclusters, method, metric
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = make_jobs(kidata.index_kidata(root), start, stop, strings, window)
+
+    def failed(job, e):
+        return {'date': job[0], 'string': job[1], 'error': repr(e)}
+
+    results = []
+    if max_workers == 1:
+        for job in jobs:
+            try:
+                results.append(run_job(*job, out_dir=out_dir, **kwargs))
+            except Exception as e:
+                results.append(failed(job, e))
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(run_job, *job, out_dir=out_dir, **kwargs)
+                       for job in jobs]
+
+            for job, future in zip(jobs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(failed(job, e))
+
+    report = pd.DataFrame(results, columns=[
+        'date', 'string', 'No. Cells', 'No. Samples', 'No. Elements',
+        'output', 'error', 'Seconds'])
+    report.to_csv(os.path.join(out_dir, 'batch report.csv'), index=False)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Cluster every date and string of a ki_data archive')
+    parser.add_argument('root', help='folder of ki_data files, searched '
+                        'recursively')
+    parser.add_argument('--start', help='first date, e.g. 2019-03-26')
+    parser.add_argument('--stop', help='last date, e.g. 2019-03-27')
+    parser.add_argument('--strings', type=int, nargs='+',
+                        help='strings to cluster (default all)')
+    parser.add_argument('--window', nargs=2, metavar=('START', 'STOP'),
+                        help='daily event window, e.g. 11:00 23:40 '
+                        '(default whole day)')
+    parser.add_argument('--nclusters', type=int, default=2)
+    parser.add_argument('--method', default='ward')
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--engine', default='scipy')
+    parser.add_argument('--resample', default='10min',
+                        help="resample rule, '' to keep 30 sec data")
+    parser.add_argument('--out-dir', default='kibatch')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    report = run_batch(args.root, args.start, args.stop, args.strings,
+                       args.window, out_dir=args.out_dir,
+                       max_workers=args.workers, nclusters=args.nclusters,
+                       method=args.method, metric=args.metric,
+                       engine=args.engine, resample=args.resample)
+
+    print(report[['date', 'string', 'No. Elements', 'error', 'Seconds']]
+          .to_string(index=False))
+
+    # non-zero exit so a scheduler notices failed jobs
+    return int(report['error'].notna().any())
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,130 @@
+'''
+Benchmarks clustering of synthetic random walks (see kignpr.py) over a grid
+of N, T, K and theta.
+
+Each stage (representation, distance, clustering, labelling) is timed and
+its peak memory recorded with tracemalloc, alongside the adjusted Rand
+index (ARI) against the known classes of the walks.
+'''
+
+import time
+import itertools
+import tracemalloc
+
+import pandas as pd
+import scipy.cluster.hierarchy as hac
+from sklearn.cluster import KMeans
+from sklearn import metrics
+
+import kignpr
+import kicluster
+
+
+# --- Clustering engines: (fit, label) functions of the GNPR and no. clusters
+ENGINES = {
+    'kmeans': (lambda gnpr, k: KMeans(init='k-means++', n_clusters=k,
+                                      n_init=10).fit(gnpr),
+               lambda fit, k: fit.labels_),
+    'minibatch': (lambda gnpr, k: kignpr.minibatch_kmeans(gnpr, k)[1],
+                  lambda labels, k: labels),
+    'ward': (lambda gnpr, k: kicluster.linkage(gnpr.T, 'ward'),
+             lambda Z, k: hac.fcluster(Z, k, criterion='maxclust')),
+    'ward-nn_chain': (lambda gnpr, k: kicluster.linkage(gnpr.T, 'ward',
+                                                        engine='nn_chain'),
+                      lambda Z, k: hac.fcluster(Z, k, criterion='maxclust')),
+}
+
+
+def benchmark_classes(finest_class, theta, K):
+    '''
+    Returns the classes GNPR should recover for theta, and their number:
+    distributions only (theta=0), clusters only (theta=1) or both
+    '''
+    if theta == 0:
+        return kignpr.get_distribution_cl(finest_class), 2
+    if theta == 1:
+        return kignpr.get_dependence_cl(finest_class), K
+
+    return finest_class, 2*K
+
+
+def _stage(row, name, func, *args):
+    # peak memory is recorded above what was allocated before the stage
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+
+    out = func(*args)
+
+    row[f'{name} (s)'] = time.perf_counter() - start
+    row[f'{name} peak (MB)'] = (tracemalloc.get_traced_memory()[1] - before) / 2**20
+
+    return out
+
+
+def run_benchmark(Ns, Ts, Ks, thetas, engines=('kmeans',), rho_market=0.1,
+                  rho_cluster=0.1, repeats=1, seed=0, out=None):
+    '''
+    Runs every combination of the parameters and returns a df with one row
+    per run, with the time and peak memory of each stage and the ARI.
+
+    Parameters
+    ----------
+    engines: names of clustering engines in ENGINES
+
+    repeats: runs per combination, each with a different seed
+
+    out: path to save results to, as json if it ends with .json and
+    otherwise as csv. Default is None, and doesn't save.
+    '''
+    rows = []
+    grid = itertools.product(Ns, Ts, Ks, thetas, engines, range(repeats))
+
+    tracemalloc.start()
+    try:
+        for N, T, K, theta, engine, rep in grid:
+            row = {'N': N, 'T': T, 'K': K, 'theta': theta,
+                   'engine': engine, 'repeat': rep}
+            fit, label = ENGINES[engine]
+
+            walks = kignpr.create_random_walks(rho_market, rho_cluster, K, N, T,
+                                               seed=seed + rep)
+            dS = kignpr.differentiate(walks)
+            classes, n_clusters = benchmark_classes(walks[:, T], theta, K)
+            kicluster.clear_linkage_cache()
+
+            dependence_repr, distribution_repr = _stage(
+                row, 'representation',
+                lambda: (kignpr.get_dependence_repr(dS),
+                         kignpr.get_distribution_repr(dS)))
+            gnpr = _stage(row, 'distance', kignpr.gnpr_from_repr,
+                          dependence_repr, distribution_repr, theta)
+            model = _stage(row, 'clustering', fit, gnpr, n_clusters)
+            labels = _stage(row, 'labelling', label, model, n_clusters)
+
+            row['total (s)'] = sum(v for k, v in row.items()
+                                   if k.endswith('(s)'))
+            row['ARI'] = metrics.adjusted_rand_score(classes, labels)
+            rows.append(row)
+
+    finally:
+        tracemalloc.stop()
+
+    results = pd.DataFrame(rows)
+
+    if out is not None:
+        if out.endswith('.json'):
+            results.to_json(out, orient='records', indent=2)
+        else:
+            results.to_csv(out, index=False)
+
+    return results
+
+
+if __name__ == "__main__":
+    results = run_benchmark(Ns=[120, 480], Ts=[1000, 10000], Ks=[3],
+                            thetas=[0, 0.5, 1],
+                            engines=['kmeans', 'minibatch', 'ward',
+                                     'ward-nn_chain'],
+                            out='benchmark.csv')
+    print(results[['N', 'T', 'theta', 'engine', 'total (s)', 'ARI']])
@@ -6,16 +6,22 @@ https://stackoverflow.com/questions/21638130/tutorial-for-scipy-cluster-hierarch
 
 # %%
 # import datetime
-# import numpy as np
+import hashlib
+import concurrent.futures
+from collections import namedtuple, OrderedDict
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 import kidata
+import kidtw
+import kishape
 
-import scipy.stats as stats
 import scipy.cluster.hierarchy as hac
-import scipy.signal as signal
+from scipy.spatial.distance import pdist
+
+# matplotlib, scipy.stats and scipy.signal are slow to import, so they are
+# imported by the functions that use them
 
 
 def cleandata(file):
@@ -28,66 +34,462 @@ def cleandata(file):
 
 
 # --- Define spearman correlation to use as distance metric
+# Passing myMetric to cluster_summary uses the vectorised pearson_distance
 def myMetric(x, y):
+    import scipy.stats as stats
+
     r = stats.pearsonr(x, y)[0]
     return 1 - r
 
 
-# ---- Applies scipy sav-gol filter then trims output
-def posttrim_savgol(data, window=31):
-    timestamps = data.index
-    battnames = data.columns
+# --- Fused filter, trim and downsample over a single numpy block
+def preprocess(data, filt='savgol', window=31, factor=1, trim=(210, 140),
+               pretrim=False, dtype=None):
+    '''
+    Filters data, trims the refresh edges to isolate the profile and
+    downsamples by factor in one pass, without intermediate dfs.
 
-    # Savitzky-Golay
-    filtered_data = signal.savgol_filter(data, window, 3, axis=0)
-    filtered_data = pd.DataFrame(filtered_data,
-                                 index=timestamps,
-                                 columns=battnames)
+    Parameters
+    ----------
+    data: df with time index and battery columns, a kidata.KiMatrix, or a
+    numpy array
 
-    # trim refresh edges to isolate profile
-    trim = filtered_data.iloc[210:-140]
-    return trim
+    filt: 'savgol' Savitzky-Golay filter of width window, keeping every
+    factor-th sample. 'resample' scipy FFT resample, 'decimate' scipy FIR
+    decimate, 'mean' mean over blocks of factor samples, or None to only
+    trim and downsample.
 
+    trim: samples removed from the (start, end) of data at its original rate
 
-# ---- Applies scipy resample then trims output
-def sp_resample(data):
-    factor = 20
-    num = len(data.index) // factor
+    pretrim: filter after trimming, so the profile is filtered without the
+    samples around it. Default is False, and filters with them.
 
-    sp_resample = pd.DataFrame(signal.resample(data, num),
-                               index=data.index[::factor],
-                               columns=data.columns)
+    dtype: working dtype, e.g. np.float32 to halve memory. Default is None,
+    and uses float32 for float32 data (e.g. a KiMatrix, which is then
+    read in place) and float64 otherwise.
 
-    trim = sp_resample.iloc[210 // factor:-140 // factor]
-    return trim
+    Returns a df if data is a df, a KiMatrix if data is a KiMatrix,
+    otherwise an array.
+    '''
+    import scipy.signal as signal
+
+    block = np.asarray(data)
+    if dtype is None:
+        dtype = np.float32 if block.dtype == np.float32 else np.float64
+    block = block.astype(dtype, copy=False)
+    head, tail = trim
+    stop = len(block) - tail
+
+    if filt == 'savgol' and not pretrim and head >= window // 2 \
+            and tail >= window // 2:
+        # only filter the samples that are kept, using the trimmed edges
+        # as the filter halo
+        half = window // 2
+        halo = block[head - half:stop + half]
+        coeffs = signal.savgol_coeffs(window, 3).astype(dtype)
+        windows = np.lib.stride_tricks.sliding_window_view(halo, window, axis=0)
+        values = np.einsum('tnw,w->tn', windows[::factor], coeffs[::-1])
+        rows = slice(head, stop, factor)
+
+    elif filt in ('savgol', 'mean', None):
+        if filt == 'savgol' and not pretrim:
+            # the trimmed edges are too short a halo, so filter everything
+            values = signal.savgol_filter(block, window, 3, axis=0)[head:stop]
+        else:
+            values = block[head:stop]
+            if filt == 'savgol':
+                values = signal.savgol_filter(values, window, 3, axis=0)
+
+        if filt == 'mean':
+            n = len(values) // factor
+            values = values[:n*factor].reshape(n, factor, -1).mean(axis=1)
+            rows = slice(head, head + n*factor, factor)
+        else:
+            values = values[::factor]
+            rows = slice(head, stop, factor)
 
+    elif filt in ('resample', 'decimate'):
+        # both need the whole signal, so trim after downsampling
+        if filt == 'resample':
+            values = signal.resample(block, len(block) // factor, axis=0)
+        else:
+            values = signal.decimate(block, factor, ftype='fir', axis=0)
 
-# ---- Applies scipy sav-gol filter after trimming first
-def pretrim_savgol(data, window=31):
-    # trim refresh edges to isolate profile
-    trim = data.iloc[210:-140]
+        trimmed = slice(head // factor, -tail // factor or None)
+        values = values[trimmed]
+        rows = np.arange(len(block))[::factor][trimmed]
+
+    else:
+        raise ValueError(f'Unknown filter: {filt}')
+
+    if isinstance(data, pd.DataFrame):
+        return pd.DataFrame(values, index=data.index[rows],
+                            columns=data.columns)
+    if isinstance(data, kidata.KiMatrix):
+        return kidata.KiMatrix(values, data.time[rows], data.cells)
 
-    timestamps = trim.index
-    battnames = trim.columns
+    return values
 
-    # Savitzky-Golay
-    filtered_data = signal.savgol_filter(trim, window, 3, axis=0)
-    filtered_data = pd.DataFrame(filtered_data,
-                                 index=timestamps,
-                                 columns=battnames)
 
-    return filtered_data
+# ---- Applies scipy sav-gol filter then trims output
+def posttrim_savgol(data, window=31):
+    return preprocess(data, 'savgol', window)
+
+
+# ---- Applies scipy resample then trims output
+def sp_resample(data):
+    return preprocess(data, 'resample', factor=20)
+
+
+# ---- Applies scipy sav-gol filter after trimming first
+def pretrim_savgol(data, window=31):
+    return preprocess(data, 'savgol', window, pretrim=True)
 
 
 # --- Return clusters along column axis from input data using scipy function
-def make_clusters(data, cut_off, method, metric):
-    D = hac.linkage(data.T, method=method, metric=metric)
+def make_clusters(data, cut_off, method, metric, engine='scipy',
+                  metric_kwargs=None):
+    if engine == 'kshape':
+        # shape-based clustering ignores method and metric
+        labels, _ = kishape.kshape(np.asarray(data).T, cut_off, seed=0)
+        return pd.Series(labels + 1)
+
+    D = linkage(data, method, metric, engine, metric_kwargs=metric_kwargs)
     raw_clusters = pd.Series(hac.fcluster(D, cut_off, criterion='maxclust'))
 
     return raw_clusters
 
 
-def cluster_summary(data, cut_off, method='single', metric='euclidean'):
+# --- Linkage trees and distance matrices are cached by a fingerprint of the
+# input data, so a cut_off sweep is just fcluster on a cached tree and
+# methods share one distance matrix. Each cache holds at most CACHE_SIZE
+# entries and CACHE_BYTES of arrays, and larger arrays aren't cached.
+CACHE_SIZE = 32
+CACHE_BYTES = 256 * 2**20
+_linkage_cache = OrderedDict()
+_distance_cache = OrderedDict()
+
+
+def fingerprint(data):
+    '''
+    Returns a hash of the values and shape of data
+    '''
+    values = np.ascontiguousarray(np.asarray(data))
+    # hashed straight from the buffer, e.g. a memory-mapped KiMatrix
+    h = hashlib.blake2b(values.reshape(-1).view(np.uint8), digest_size=16)
+    h.update(f'{values.shape}{values.dtype}'.encode())
+
+    return h.hexdigest()
+
+
+def _cache_get(cache, key, func):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    value = func()
+    if value.nbytes > CACHE_BYTES:
+        return value
+
+    value.flags.writeable = False  # shared between callers
+    cache[key] = value
+    while (len(cache) > CACHE_SIZE
+           or sum(v.nbytes for v in cache.values()) > CACHE_BYTES):
+        cache.popitem(last=False)
+
+    return value
+
+
+def clear_linkage_cache():
+    _linkage_cache.clear()
+    _distance_cache.clear()
+
+
+def distances(data, metric='euclidean', key=None, metric_kwargs=None):
+    '''
+    Returns the condensed distance matrix between the columns of data,
+    cached on the data fingerprint, metric and metric_kwargs.
+
+    metric is a name in METRICS, myMetric (computed as 'pearson'), or
+    anything accepted by scipy's pdist.
+
+    metric_kwargs: dict of keyword arguments for the metric, e.g.
+    {'window': 30, 'cutoff': 0.5} for 'dtw'. Default is None.
+    '''
+    key = fingerprint(data) if key is None else key
+    metric_kwargs = metric_kwargs or {}
+
+    if metric is myMetric:
+        metric = 'pearson'
+
+    def compute():
+        X = _features(data)
+        if isinstance(metric, str) and metric in METRICS:
+            return METRICS[metric](X, **metric_kwargs)
+
+        # pdist works in float64
+        return pdist(X.astype(np.float64, copy=False), metric=metric,
+                     **metric_kwargs)
+
+    return _cache_get(_distance_cache,
+                      (key, metric, tuple(sorted(metric_kwargs.items()))),
+                      compute)
+
+
+def _features(data):
+    # columns of data as rows, without copying float32 data (e.g. a
+    # KiMatrix); anything else is converted to float64
+    X = np.asarray(data)
+    dtype = np.float32 if X.dtype == np.float32 else np.float64
+
+    return X.astype(dtype, copy=False).T
+
+
+# --- Vectorised distance metrics. Each takes an array with one series per
+# row and returns a condensed distance matrix without per-pair Python calls
+def _condensed_gram(Z, chunk_size=1024):
+    # dot products between rows of Z, upper triangle in pdist order
+    N = len(Z)
+    out = np.empty(N * (N - 1) // 2)
+
+    pos = 0
+    for start in range(0, N - 1, chunk_size):
+        stop = min(start + chunk_size, N - 1)
+        gram = Z[start:stop] @ Z[start:].T
+        rows, cols = np.triu_indices(stop - start, k=1, m=N - start)
+
+        out[pos:pos + len(rows)] = gram[rows, cols]
+        pos += len(rows)
+
+    return out
+
+
+def pearson_distance(X, chunk_size=1024):
+    '''
+    1 - Pearson correlation between rows of X. Rows are z-normalised once
+    so the correlations are a single blocked matrix product.
+    '''
+    Z = kishape.zscore(X, X.dtype) / np.sqrt(X.shape[1], dtype=X.dtype)
+
+    return np.clip(1 - _condensed_gram(Z, chunk_size), 0, 2)
+
+
+def spearman_distance(X, chunk_size=1024):
+    '''
+    1 - Spearman rank correlation between rows of X
+    '''
+    import scipy.stats as stats
+
+    return pearson_distance(stats.rankdata(X, axis=1), chunk_size)
+
+
+def gnpr_distance(X, theta=0.5):
+    '''
+    Euclidean distance between the GNPR of the increments of each row of X,
+    see kignpr.py
+    '''
+    import kignpr
+
+    return pdist(kignpr.get_gnpr(np.diff(X, axis=1), theta))
+
+
+def sbd_distance(X):
+    '''
+    Shape-based distance between rows of X, i.e. 1 - the best normalised
+    cross-correlation over all shifts, see kishape.py. Rows are z-normalised
+    first, as in kishape.kshape(), so the DC offset of the voltages doesn't
+    dominate the cross-correlation.
+    '''
+    Z = kishape.zscore(X)
+    dists = kishape.sbd(Z, Z)[0]
+
+    return np.clip(dists[np.triu_indices(len(X), k=1)], 0, 2)
+
+
+def dtw_distance(X, window=None, cutoff=None):
+    '''
+    Windowed dynamic time warping distance between rows of X, which doesn't
+    penalise small time shifts between profiles, see kidtw.py. Pass window
+    and cutoff through metric_kwargs, e.g. cluster_summary(data, 4,
+    metric='dtw', metric_kwargs={'cutoff': 0.5}).
+    '''
+    return kidtw.dtw_pdist(X, window, cutoff)
+
+
+METRICS = {'pearson': pearson_distance,
+           'spearman': spearman_distance,
+           'gnpr': gnpr_distance,
+           'sbd': sbd_distance,
+           'dtw': dtw_distance}
+
+
+def linkage(data, method='single', metric='euclidean', engine='scipy',
+            chunk_size=1024, metric_kwargs=None):
+    '''
+    Returns a scipy linkage matrix clustering the columns of data. Results
+    are cached, see clear_linkage_cache().
+
+    Parameters
+    ----------
+    engine: 'scipy' runs hac.linkage on a dense distance matrix, which needs
+    O(N^2) memory. 'mst' (single method) and 'nn_chain' (ward method) work
+    directly from the feature matrix in blocks of chunk_size rows using
+    O(N) extra memory, for clustering tens of thousands of profiles.
+    Both only support the euclidean metric.
+
+    metric_kwargs: passed to the metric, see distances(). A 'dtw' cutoff
+    replaces distances above it with lower bounds, so it is only allowed
+    with the single and complete methods, whose merges below the cutoff
+    don't depend on larger distances.
+    '''
+    key = fingerprint(data)
+    metric_kwargs = metric_kwargs or {}
+
+    return _cache_get(_linkage_cache,
+                      (key, method, metric, engine,
+                       tuple(sorted(metric_kwargs.items()))),
+                      lambda: _linkage(data, method, metric, engine,
+                                       chunk_size, key, metric_kwargs))
+
+
+def _linkage(data, method, metric, engine, chunk_size, key, metric_kwargs):
+    if engine == 'scipy':
+        # hac.linkage only checks this when given observations
+        if method in ('centroid', 'median', 'ward') and metric != 'euclidean':
+            raise ValueError(f"Method '{method}' requires the distance "
+                             "metric to be Euclidean")
+
+        if (metric == 'dtw' and metric_kwargs.get('cutoff') is not None
+                and method not in ('single', 'complete')):
+            raise ValueError(f"Method '{method}' mixes pruned DTW lower "
+                             "bounds into merges below the cutoff, use "
+                             "method='single' or 'complete'")
+
+        return hac.linkage(distances(data, metric, key, metric_kwargs),
+                           method=method)
+
+    lowmem = {'mst': ('single', _mst_linkage),
+              'nn_chain': ('ward', _nn_chain_linkage)}
+
+    if engine not in lowmem:
+        raise ValueError(f'Unknown linkage engine: {engine}')
+    if method != lowmem[engine][0] or metric != 'euclidean':
+        raise ValueError(f"Engine '{engine}' only supports "
+                         f"method='{lowmem[engine][0]}', metric='euclidean'")
+
+    return lowmem[engine][1](_features(data), chunk_size)
+
+
+def _block_dists(X, x, rows, chunk_size):
+    # euclidean distance from x to X[rows], chunk_size rows at a time, in
+    # the dtype of X
+    x = x.astype(X.dtype, copy=False)
+    out = np.empty(len(rows))
+    for i in range(0, len(rows), chunk_size):
+        block = X[rows[i:i+chunk_size]] - x
+        out[i:i+chunk_size] = np.sqrt(np.einsum('ij,ij->i', block, block))
+
+    return out
+
+
+def _mst_linkage(X, chunk_size):
+    # Prim's algorithm: single linkage is the minimum spanning tree
+    N = X.shape[0]
+    in_tree = np.zeros(N, dtype=bool)
+    nearest = np.full(N, np.inf)
+    parent = np.zeros(N, dtype=int)
+
+    merges = []
+    current = 0
+    for _ in range(N - 1):
+        in_tree[current] = True
+        rows = np.flatnonzero(~in_tree)
+
+        d = _block_dists(X, X[current], rows, chunk_size)
+        closer = d < nearest[rows]
+        nearest[rows[closer]] = d[closer]
+        parent[rows[closer]] = current
+
+        current = rows[np.argmin(nearest[rows])]
+        merges.append((parent[current], current, nearest[current]))
+
+    return _merges_to_linkage(merges, N)
+
+
+def _nn_chain_linkage(X, chunk_size):
+    # Nearest-neighbour chain on cluster centroids; the ward distance between
+    # two clusters only depends on their centroids and sizes. Centroids
+    # start as a row-major copy of X, the only copy made.
+    N = X.shape[0]
+    centroids = np.array(X, order='C')
+    sizes = np.ones(N)
+    active = np.ones(N, dtype=bool)
+
+    merges = []
+    chain = []
+    while len(merges) < N - 1:
+        if len(chain) == 0:
+            chain.append(np.flatnonzero(active)[0])
+
+        a = chain[-1]
+        active[a] = False
+        rows = np.flatnonzero(active)
+        active[a] = True
+
+        d = _block_dists(centroids, centroids[a], rows, chunk_size)
+        d *= np.sqrt(2*sizes[a]*sizes[rows] / (sizes[a] + sizes[rows]))
+        b = rows[np.argmin(d)]
+        dist = d.min()
+
+        # prefer the previous link on ties so the chain always terminates
+        if len(chain) > 1:
+            prev = np.searchsorted(rows, chain[-2])
+            if d[prev] <= dist:
+                b, dist = chain[-2], d[prev]
+
+        if len(chain) > 1 and b == chain[-2]:
+            del chain[-2:]
+
+            # merged cluster takes the slot of b
+            size = sizes[a] + sizes[b]
+            centroids[b] = (sizes[a]*centroids[a] + sizes[b]*centroids[b]) / size
+            sizes[b] = size
+            active[a] = False
+            merges.append((a, b, dist))
+        else:
+            chain.append(b)
+
+    return _merges_to_linkage(merges, N)
+
+
+def _merges_to_linkage(merges, N):
+    '''
+    Converts merges between representative points, in any order, to a scipy
+    linkage matrix by sorting on distance and labelling with union-find
+    '''
+    merges = sorted(merges, key=lambda m: m[2])
+
+    root = np.arange(2*N - 1)
+    sizes = np.ones(2*N - 1)
+
+    def find(x):
+        while root[x] != x:
+            root[x] = root[root[x]]
+            x = root[x]
+        return x
+
+    Z = np.zeros((N - 1, 4))
+    for i, (a, b, dist) in enumerate(merges):
+        ra, rb = find(a), find(b)
+        sizes[N + i] = sizes[ra] + sizes[rb]
+        Z[i] = [min(ra, rb), max(ra, rb), dist, sizes[N + i]]
+        root[ra] = root[rb] = N + i
+
+    return Z
+
+
+def cluster_summary(data, cut_off, method='single', metric='euclidean',
+                    engine='scipy', compact=False, metric_kwargs=None):
     '''
     Runs clustering on a dataset and returns a summary of clusters, including:
         - indices of elements within a cluster (Indices)
@@ -99,29 +501,180 @@ def cluster_summary(data, cut_off, method='single', metric='euclidean'):
     data: a pandas series of battery position and equivalent cluster
 
     cut_off: dendrogram cutoff, i.e. number of clusters to make
+
+    engine: linkage engine, see linkage(), or 'kshape' to cluster by shape
+    with k-Shape (see kishape.py), which tolerates shifted profiles and
+    scales linearly with the number of cells
+
+    compact: also return the cluster membership as a ClusterLabels of
+    arrays, i.e. returns (summary, labels)
+
+    metric_kwargs: dict of keyword arguments for the metric, e.g. the
+    window and cutoff of 'dtw', see linkage()
     '''
-    raw_clusters = make_clusters(data, cut_off, method, metric)
-    clusters = [i for i in range(1, cut_off+1)]
+    raw_clusters = make_clusters(data, cut_off, method, metric, engine,
+                                 metric_kwargs)
+
+    return summarise_clusters(raw_clusters, data, cut_off, compact)
+
 
-    cluster_indices, lens, batts = [], [], []
+# --- Array-backed cluster membership. Column indices of cluster c are
+# order[offsets[c-1]:offsets[c]]
+ClusterLabels = namedtuple('ClusterLabels', ['labels', 'order', 'offsets'])
 
-    for c in clusters:
-        indices = list(raw_clusters[raw_clusters == c].index)
-        cluster_indices.append(indices)
-        lens.append(len(indices))
-        batts.append(list(data.columns[indices]))
 
-    d = {'Cluster': clusters,
-         'Indices': cluster_indices,
+def summarise_clusters(raw_clusters, data, cut_off, compact=False):
+    '''
+    Returns the cluster summary of cluster_summary() from a series of
+    cluster labels (1 to cut_off) for each column of data
+    '''
+    labels = np.asarray(raw_clusters)
+
+    # one stable sort groups the columns of every cluster in index order
+    order = np.argsort(labels, kind='stable')
+    lens = np.bincount(labels, minlength=cut_off+1)[1:cut_off+1]
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+
+    cluster_indices = np.split(order, offsets[1:-1])
+    batts = np.split(np.asarray(data.columns, dtype=object)[order],
+                     offsets[1:-1])
+
+    d = {'Cluster': np.arange(1, cut_off+1),
+         'Indices': [i.tolist() for i in cluster_indices],
          'No. Elements': lens,
-         'Battery position': batts}
+         'Battery position': [b.tolist() for b in batts]}
 
     summary = pd.DataFrame(d).sort_values('No. Elements', ascending=False) \
                              .reset_index(drop=True)
 
+    if compact:
+        return summary, ClusterLabels(labels, order, offsets)
+
     return summary
 
 
+# --- Cluster model for assigning new profiles to existing clusters
+def fit_cluster_model(data, cut_off, method='ward', metric='euclidean',
+                      engine='scipy'):
+    '''
+    Clusters the columns of data and returns a model that new profiles of
+    the same length can be assigned to with assign_clusters().
+
+    The model is a dict of numpy arrays so it can be saved with
+    save_cluster_model(), and contains:
+        - cluster labels (clusters)
+        - mean profile of each cluster (centroids)
+        - mean member distance from each centroid (spread), floored for
+          singleton clusters, see _spread_floor()
+        - linkage heights either side of the cut (cut_heights)
+
+    Only the euclidean metric is supported, as new profiles are assigned
+    by their euclidean distance to the centroids.
+    '''
+    if metric != 'euclidean':
+        raise ValueError("Cluster models only support metric='euclidean', "
+                         "as profiles are assigned by euclidean distance "
+                         "to the cluster centroids")
+
+    D = linkage(data, method, metric, engine)
+    labels = hac.fcluster(D, cut_off, criterion='maxclust')
+
+    X = _features(data)
+    clusters, members = np.unique(labels, return_inverse=True)
+    counts = np.bincount(members)
+
+    # sums of each cluster as one product with its indicator, without
+    # copying X
+    indicator = np.zeros((len(clusters), len(X)), dtype=X.dtype)
+    indicator[members, np.arange(len(X))] = 1
+    centroids = (indicator @ X).astype(np.float64) / counts[:, None]
+
+    spread = np.array([
+        _block_dists(X, centroids[k], np.flatnonzero(members == k), 1024).mean()
+        for k in range(len(clusters))])
+
+    # fcluster cuts between these two merges
+    K = len(clusters)
+    cut_heights = D[[-K, -K + 1], 2] if K > 1 else D[[-1, -1], 2]
+    spread[spread == 0] = _spread_floor(spread, cut_heights)
+
+    return {'clusters': clusters,
+            'centroids': centroids,
+            'spread': spread,
+            'cut_heights': cut_heights,
+            'cut_off': np.array(cut_off),
+            'method': np.array(method),
+            'metric': np.array(metric),
+            'engine': np.array(engine)}
+
+
+def _spread_floor(spread, cut_heights):
+    # A singleton cluster has no spread, so any profile assigned to it
+    # would count as infinitely far off. Use the median spread of the other
+    # clusters instead, or half the height of the last merge below the cut
+    # if every cluster is a singleton.
+    floor = np.median(spread[spread > 0]) if np.any(spread > 0) \
+        else cut_heights[0] / 2
+
+    return max(floor, np.finfo(np.float64).eps)
+
+
+def assign_clusters(model, data):
+    '''
+    Assigns each column of data to the nearest cluster centroid in O(N.K).
+    Returns a series of cluster labels and an array of distances to the
+    assigned centroids.
+
+    Distances are computed in blocks in the dtype of data, so float32 data
+    (e.g. a KiMatrix) isn't copied.
+    '''
+    X = _features(data)
+    rows = np.arange(len(X))
+
+    all_dists = np.column_stack([_block_dists(X, c, rows, 1024)
+                                 for c in model['centroids']])
+    nearest = np.argmin(all_dists, axis=1)
+    dists = all_dists[rows, nearest]
+
+    raw_clusters = pd.Series(model['clusters'][nearest])
+
+    return raw_clusters, dists
+
+
+def update_cluster_model(model, data, drift=0.1):
+    '''
+    Assigns new profiles to the clusters of model, and re-clusters from
+    scratch if profiles lie further from their centroids than the members
+    the model was fitted on, i.e. if the mean ratio of distance to cluster
+    spread exceeds 1 + drift.
+
+    Returns the (possibly refitted) model, a cluster summary of data and
+    whether a full re-cluster was run.
+    '''
+    raw_clusters, dists = assign_clusters(model, data)
+    spread = model['spread'][np.searchsorted(model['clusters'], raw_clusters)]
+
+    refit = np.mean(dists / spread) > 1 + drift
+    if refit:
+        model = fit_cluster_model(data, int(model['cut_off']),
+                                  str(model['method']), str(model['metric']),
+                                  str(model['engine']))
+        raw_clusters, dists = assign_clusters(model, data)
+
+    summary = summarise_clusters(raw_clusters, data, int(model['cut_off']))
+
+    return model, summary, refit
+
+
+def save_cluster_model(model, file):
+    np.savez(file, **model)
+
+
+def load_cluster_model(file):
+    with np.load(file) as f:
+        return {k: f[k] for k in f.files}
+
+
 def sm_highlights(h_list, summary):
     '''Append selected batteries for highlighting to summary df
     Parameters:
@@ -144,7 +697,7 @@ def sm_highlights(h_list, summary):
 
 def plot_clusters(sm, data, nplots=10, envelope=False,
                   highlights=False, legend=True, plot_title=None,
-                  save_plot=False):
+                  save_plot=False, fast=False, max_workers=None):
     '''Plots clusters from data using cluster summary
     Parameters:
     -----------
@@ -153,7 +706,16 @@ def plot_clusters(sm, data, nplots=10, envelope=False,
     envelope: plots a shaded min-max envelope if True
     highlights: list of batteries to highlight (TODO)
     nplots: maximum number of plots to show
+    fast: draws decimated traces as one artist per figure, see
+    plot_clusters_fast()
+    max_workers: number of processes rendering saved plots if fast
     '''
+    if fast:
+        return plot_clusters_fast(sm, data, nplots, envelope, highlights,
+                                  plot_title, save_plot, max_workers)
+
+    import matplotlib.pyplot as plt
+
     if highlights:
         kwargs={
             'color': '0.8',
@@ -225,14 +787,140 @@ def plot_clusters(sm, data, nplots=10, envelope=False,
     plt.show()
 
 
-# ========== Input parameters ==========
-data = cleandata(file='30sec data.csv')
-nclusters = 4   # dendrogram cutoff
-save_plot = False
-# ========== ================ ==========
+def plot_clusters_fast(sm, data, nplots=10, envelope=False, highlights=False,
+                       plot_title=None, save_plot=False, max_workers=None):
+    '''
+    Plots clusters like plot_clusters(), but draws the envelope as a
+    min-max and 5-95 percentile band of all batteries, computed once, and
+    the members of each cluster as a single LineCollection. Traces are
+    decimated to the min and max of each pixel column (see
+    kidata.minmax_buckets()), so a figure costs the same however many
+    batteries and samples it shows.
+
+    Saved plots are rendered in parallel with the Agg backend, using
+    max_workers processes (None uses the number of processors, 1 renders
+    in this process). Otherwise the figures are shown.
+    '''
+    figsize, dpi = ((10, 7), 200) if save_plot else ((6, 3.5), 100)
+    n_buckets = int(figsize[0] * dpi)
+
+    values = np.asarray(data, dtype=np.float64)
+    is_date = isinstance(data.index, pd.DatetimeIndex)
+    if is_date:
+        import matplotlib.dates as mdates
+        x = mdates.date2num(data.index)
+    else:
+        x = np.asarray(data.index, dtype=np.float64)
+
+    band = _envelope_band(x, values, n_buckets) if envelope else None
+
+    panels = []
+    for idx, members in enumerate(sm['Battery position'][:nplots]):
+        cols = data.columns.get_indexer(members)
+        if (cols < 0).any():
+            raise KeyError(f'{np.asarray(members)[cols < 0].tolist()} not in data')
+        rows = kidata.minmax_buckets(values[:, cols], n_buckets)
+
+        # (no. members, no. points, 2) array of line vertices
+        segments = np.stack([x[rows], np.take_along_axis(values[:, cols], rows, 0)],
+                            axis=-1).transpose(1, 0, 2)
+
+        n = sm['No. Elements'][idx]
+        cl_name = f'Cluster {idx} ({n}) - average method'
+        panels.append({
+            'segments': segments,
+            'band': band,
+            'is_date': is_date,
+            'highlights': bool(highlights),
+            'labels': list(members) if n < 7 else None,
+            'title': cl_name if plot_title is None else plot_title,
+            'file': f'charts/{cl_name}',
+            'figsize': figsize,
+            'dpi': dpi})
+
+    if not save_plot:
+        import matplotlib.pyplot as plt
+
+        for panel in panels:
+            fig, ax = plt.subplots(figsize=figsize)
+            _draw_panel(ax, panel)
+        plt.show()
+        return
 
-if __name__ == "__main__":
-    # plot clusters based on original grafana export
+    if max_workers == 1:
+        return list(map(_render_panel, panels))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        return list(pool.map(_render_panel, panels))
+
+
+def _envelope_band(x, values, n_buckets):
+    # min, 5th and 95th percentile and max over batteries at each time,
+    # widened to cover every sample in each bucket
+    with np.errstate(invalid='ignore'):
+        lo, q5, q95, hi = np.nanpercentile(values, [0, 5, 95, 100], axis=1)
+
+    starts = np.arange(0, len(x), -(-len(x) // n_buckets))
+    band = (np.minimum.reduceat(lo, starts), np.minimum.reduceat(q5, starts),
+            np.maximum.reduceat(q95, starts), np.maximum.reduceat(hi, starts))
+
+    # repeat the last step at the last sample so the band spans all of x
+    return (np.append(x[starts], x[-1]),
+            *(np.append(b, b[-1]) for b in band))
+
+
+def _draw_panel(ax, panel):
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    if panel['band'] is not None:
+        x, lo, q5, q95, hi = panel['band']
+        ax.fill_between(x, lo, hi, color='0.9', lw=0, step='post')
+        ax.fill_between(x, q5, q95, color='0.75', lw=0, step='post')
+
+    if panel['highlights']:
+        colors, alpha = ['0.8'], 0.5
+    else:
+        colors, alpha = [f'C{i % 10}' for i in range(len(panel['segments']))], None
+
+    ax.add_collection(LineCollection(panel['segments'], colors=colors,
+                                     alpha=alpha, linewidths=1))
+    ax.autoscale_view()
+    if panel['is_date']:
+        ax.xaxis_date()
+
+    ax.set_title(panel['title'])
+    ax.set_ylabel("Battery Voltage")
+
+    # Show legend if there are < 7 batteries displayed
+    if panel['labels'] is not None:
+        labels = panel['labels']
+        ax.legend([Line2D([], [], color=colors[i % len(colors)], alpha=alpha)
+                   for i in range(len(labels))], labels)
+
+
+def _render_panel(panel):
+    # a bare Agg figure, without pyplot, so processes don't share a GUI
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=panel['figsize'])
+    FigureCanvasAgg(fig)
+    _draw_panel(fig.add_subplot(), panel)
+    fig.savefig(panel['file'], bbox_inches='tight', dpi=panel['dpi'])
+
+    return panel['file']
+
+
+def main(file='30sec data.csv', nclusters=4, save_plot=False):
+    '''
+    Plots clusters based on original grafana export
+
+    nclusters: dendrogram cutoff
+    '''
+    import matplotlib.pyplot as plt
+
+    data = cleandata(file)
     filtered_data = sp_resample(data)
     sm = cluster_summary(filtered_data, nclusters,
                          method='average', metric='euclidean')
@@ -253,3 +941,7 @@ if __name__ == "__main__":
     if save_plot:
         plt.savefig('./charts/Original data', bbox_inches='tight', dpi=200)
     plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,101 @@ All data munge returns time index and battery columns
 
 # %%
 import os
+import re
+import glob
+import hashlib
+from collections import namedtuple
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+
+# --- Parsed files are cached in this folder next to the source file
+CACHE_DIR = '.kicache'
+
+
+def file_hash(file, blocksize=2**20):
+    '''
+    Returns a hex digest of the contents of file
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def _cache_stem(file, parser, args):
+    # One cache entry per (file, parser, args); the content hash goes last
+    # so stale entries for an edited file can be found and removed
+    tag = hashlib.blake2b(f'{parser.__name__}{args}'.encode(),
+                          digest_size=4).hexdigest()
+    folder = os.path.join(os.path.dirname(os.path.abspath(file)), CACHE_DIR)
+
+    return os.path.join(folder, f'{os.path.basename(file)}.{tag}')
+
+
+def cached_read(parser, file, *args):
+    '''
+    Returns parser(file, *args), loading it from a columnar cache if the
+    file has been parsed before with identical contents.
+
+    The cache is written as parquet, or as a pickle if no parquet engine
+    is installed. Entries are keyed on a hash of the file contents, so an
+    edited file is re-parsed automatically.
+    '''
+    stem = _cache_stem(file, parser, args)
+    path = f'{stem}.{file_hash(file)}'
+
+    df = _read_table(path)
+    if df is not None:
+        return df
+
+    df = parser(file, *args)
+    _write_table(df, path, stale=glob.glob(glob.escape(stem) + '.*'))
+
+    return df
+
+
+def _read_table(path):
+    # path without extension, see _write_table()
+    if os.path.exists(path + '.parquet'):
+        return pd.read_parquet(path + '.parquet')
+    if os.path.exists(path + '.pkl'):
+        return pd.read_pickle(path + '.pkl')
+
+    return None
+
+
+def _write_table(df, path, stale=()):
+    # parquet, or a pickle if no parquet engine is installed
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for old in stale:
+            os.remove(old)
+
+        try:
+            df.to_parquet(path + '.parquet')
+        except ImportError:
+            df.to_pickle(path + '.pkl')
+
+    except OSError:
+        # caching is best effort, e.g. the data folder may be read-only
+        pass
+
 
 # --- Munges a Grafana file
-def mungedata(file):
+def mungedata(file, cache=True):
+    '''
+    Returns cached data if file is unchanged since it was last parsed,
+    unless cache is False
+    '''
+    if cache:
+        return cached_read(_mungedata, file)
+
+    return _mungedata(file)
+
+
+def _mungedata(file):
     df = pd.read_csv(file, sep=';', skiprows=1)
 
     df['Time'] = (pd.to_datetime(df.Time, utc=True) +
@@ -26,10 +116,31 @@ def mungedata(file):
 
 
 # --- Munges InfluxDB_Monthly backup files (extracted .csv.gz from \\ki_data)
-def open_kidata_csv(file, idx='date', get_i=False, get_soc=False):
+def open_kidata_csv(file, idx='date', get_i=False, get_soc=False,
+                    cache=True):
     '''
     Returns current if get_i is True
+
+    Returns cached data if file is unchanged since it was last parsed,
+    unless cache is False
     '''
+    if cache:
+        return cached_read(_open_kidata_csv, file, idx, get_i, get_soc)
+
+    return _open_kidata_csv(file, idx, get_i, get_soc)
+
+
+def _open_kidata_csv(file, idx, get_i, get_soc):
+    df = pd.read_csv(file, index_col=idx,
+                     usecols=_kidata_usecols(get_i, get_soc))
+
+    df.index = pd.to_datetime(df.index)
+    df = df.dropna(axis=1, how='all')
+
+    return df
+
+
+def _kidata_usecols(get_i=False, get_soc=False):
     skip_cols = ['I', 'V', 'soc', 'sid']
 
     if get_i:
@@ -38,16 +149,113 @@ def open_kidata_csv(file, idx='date', get_i=False, get_soc=False):
     if get_soc:
         skip_cols.remove('soc')
 
-    df = pd.read_csv(file, index_col=idx,
-                     usecols=lambda x: x not in skip_cols)
+    return lambda x: x not in skip_cols
 
-    df.index = pd.to_datetime(df.index)
-    df = df.dropna(axis=1, how='all')
 
-    return df
+# --- Matches the string number and date at the end of a ki_data filename
+KIDATA_NAME = re.compile(r'(?P<string>\d).(?P<date>\d{4}-\d{2}-\d{2})\.csv(\.gz)?$')
 
 
-def get_files(d, s):
+def parse_kidata_name(file):
+    '''
+    Returns (string, date) from a ki_data filename, or None if the name
+    does not follow the backup naming scheme. Works for .csv and .csv.gz.
+    '''
+    match = KIDATA_NAME.search(os.path.basename(file))
+    if match is None:
+        return None
+
+    return int(match['string']), match['date']
+
+
+def iter_kidata_csv(files, start=None, stop=None, chunksize=2880,
+                    idx='date', get_i=False, get_soc=False):
+    '''
+    Yields chunks of ki_data trimmed to a time window, reading files in date
+    order. Only one chunk is held in memory at a time.
+
+    Files whose date lies outside the window are never opened, and reading
+    a file stops at the first chunk past the end of the window.
+
+    Unlike open_kidata_csv(), empty battery columns are kept so that every
+    chunk has the same columns.
+
+    Parameters
+    ----------
+    files: list of ki_data files (.csv or .csv.gz)
+
+    start, stop: window bounds, e.g. '2019-03-26, 10:30' and
+    '2019-03-27, 09:00'. Default is None, and leaves that side open. As
+    with df['2019-03-26, 10:30':'2019-03-27, 09:00'], a string stop
+    includes the whole of its last unit, e.g. the 09:00:30 sample.
+
+    chunksize: number of rows per chunk (2880 is one day of 30 sec data)
+    '''
+    start = None if start is None else pd.Timestamp(start)
+    if isinstance(stop, str):
+        # end of the period the string resolves to, as partial-string slicing
+        stop = pd.Period(stop).end_time
+    elif stop is not None:
+        stop = pd.Timestamp(stop)
+
+    def file_date(file):
+        name = parse_kidata_name(file)
+        return None if name is None else pd.Timestamp(name[1])
+
+    # Unrecognised names can't be skipped by date so read them first
+    dated = [(file_date(f), f) for f in files]
+    dated.sort(key=lambda x: (x[0] is not None, x[0] or pd.Timestamp(0)))
+
+    for date, file in dated:
+        if date is not None:
+            if stop is not None and date > stop:
+                continue
+            if start is not None and date + pd.DateOffset(days=1) <= start:
+                continue
+
+        reader = pd.read_csv(file, index_col=idx, chunksize=chunksize,
+                             usecols=_kidata_usecols(get_i, get_soc))
+
+        with reader:
+            for chunk in reader:
+                chunk.index = pd.to_datetime(chunk.index)
+
+                trim = chunk.loc[start:stop]
+                if len(trim) > 0:
+                    yield trim
+
+                if stop is not None and chunk.index[-1] > stop:
+                    break
+
+
+def index_kidata(root='.', recursive=True):
+    '''
+    Returns a df of the ki_data files under root, with one row per file and
+    columns string, date ('YYYY-MM-DD') and file (path including root),
+    sorted by date then string. Files not following the backup naming
+    scheme (see parse_kidata_name()) are left out.
+
+    recursive: also index subfolders, e.g. the monthly folders of an archive
+    '''
+    rows = []
+    for folder, subfolders, names in os.walk(root):
+        if not recursive:
+            subfolders.clear()
+        # parsed files are cached alongside the data
+        if CACHE_DIR in subfolders:
+            subfolders.remove(CACHE_DIR)
+
+        for name in names:
+            parsed = parse_kidata_name(name)
+            if parsed is not None:
+                rows.append((*parsed, os.path.join(folder, name)))
+
+    index = pd.DataFrame(rows, columns=['string', 'date', 'file'])
+
+    return index.sort_values(['date', 'string', 'file'], ignore_index=True)
+
+
+def get_files(d, s, root='.'):
     '''
     Get list of filenames from ki_data by matching date and string
     Parameters
@@ -55,32 +263,41 @@ def get_files(d, s):
     d: list of dates
 
     s: list of strings
+
+    root: folder containing the files (not searched recursively)
     '''
     if type(d) != list:
         d = [d]
     if type(s) != list:
         s = [s]
 
-    files = [f for f in os.listdir() if f[19:-4] in d and int(f[17]) in s]
+    index = index_kidata(root, recursive=False)
+    match = index['date'].isin(d) & index['string'].isin(s)
 
-    return files
+    return index.loc[match, 'file'].tolist()
 
 
-def plot_kidata(files, current=False):
+def plot_kidata(files, current=False, n_out=None, method='minmax'):
     '''
     Take a list of files and plot the voltage/current of one battery from
     each file on a single graph.
+
+    Traces are downsampled to n_out points (see downsample()), keeping
+    minima and maxima. Default is None, and uses two points per pixel of
+    the plot width.
     '''
+    import matplotlib.pyplot as plt
+
     if current:
         for file in files:
-            date = file[19:-4]
+            date = parse_kidata_name(file)[1]
 
             # get last battery (99) and current
             df = open_kidata_csv(file, get_i=True).iloc[:, -5:-3]
 
             fig, ax = plt.subplots()
             # df.plot(legend=False, ax=ax, alpha=0.6)
-            res = df.resample('5T').mean()
+            res = downsample(df, n_out or 2*int(ax.bbox.width), method)
             res.plot(y='1', label='Voltage', ax=ax)
             plt.ylim((1.7, 2.5))
 
@@ -92,10 +309,12 @@ def plot_kidata(files, current=False):
 
     else:
         fig, ax = plt.subplots()
+        # files usually hold one day each, sharing the width of the plot
+        n = n_out or max(2*int(ax.bbox.width) // max(len(files), 1), 4)
         for file in files:
             df = open_kidata_csv(file).iloc[:, 0]
 
-            df.plot(ax=ax)
+            downsample(df, n, method).plot(ax=ax)
             ax.xaxis.grid(True, which='major')
 
         plt.show()
@@ -103,8 +322,8 @@ def plot_kidata(files, current=False):
 
 def save_refresh():
     '''
-    Combine a refresh that extends over multiple dates and create a new df
-    using concat. Trim df down to refresh period only and save output as csv
+    Combine a refresh that extends over multiple dates, trimmed down to the
+    refresh period only, and save output as csv
     '''
     dates = ['2019-03-26', '2019-03-27']
 
@@ -113,14 +332,376 @@ def save_refresh():
         os.chdir(mydir)
         files = get_files(dates, string)
 
-        df = pd.DataFrame()
-        for file in files:
-            df = pd.concat([df, open_kidata_csv(file)], axis=0)
+        # --- stream the refresh period straight to disk
+        chunks = iter_kidata_csv(files,
+                                 start='2019-03-26, 10:30',
+                                 stop='2019-03-27, 09:00')
+
+        out = f'{dates[0]}_String {string}.csv'
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(out, mode='w' if i == 0 else 'a', header=i == 0)
+
 
-        # --- trim to refresh
-        df = df['2019-03-26, 10:30':'2019-03-27, 09:00']
+# --- Decimation for plotting
+def minmax_buckets(values, n_buckets):
+    '''
+    Returns the row indices of the min and max of each column of values in
+    each of n_buckets equal buckets of rows, in row order, as a
+    (2 x no. buckets, no. columns) array. Plotting only these points looks
+    the same as plotting every point when there is one bucket per pixel.
+
+    Returns every row index if there are no more than 2 x n_buckets rows.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    values = values.reshape(len(values), -1)
+    T, M = values.shape
+
+    if T <= 2*n_buckets:
+        return np.repeat(np.arange(T)[:, None], M, axis=1)
+
+    # pad with the last row so that every bucket is the same size
+    size = -(-T // n_buckets)
+    n = -(-T // size)
+    padded = np.concatenate([values, np.repeat(values[-1:], n*size - T, axis=0)])
+    padded = padded.reshape(n, size, M)
+
+    # missing values are never picked unless a whole bucket is missing
+    missing = np.isnan(padded)
+    start = np.arange(n)[:, None] * size
+    lo = start + np.where(missing, np.inf, padded).argmin(axis=1)
+    hi = start + np.where(missing, -np.inf, padded).argmax(axis=1)
+
+    idx = np.stack([np.minimum(lo, hi), np.maximum(lo, hi)], axis=1)
+
+    return np.minimum(idx.reshape(2*n, M), T - 1)
+
+
+def lttb(y, n_out, x=None):
+    '''
+    Returns the indices of n_out points of y chosen by largest triangle
+    three buckets (LTTB), which keeps the points that most change the shape
+    of the line. The first and last points are always kept.
 
-        df.to_csv(f'{dates[0]}_String {string}.csv')
+    x: positions of the points. Default is None, and uses evenly spaced
+    points.
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+
+    # n_out - 2 buckets between the first and last points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i+1]
+
+        # third vertex is the mean of the next bucket, or the last point
+        if i == n_out - 3:
+            cx, cy = x[-1], y[-1]
+        else:
+            cx, cy = x[hi:edges[i+2]].mean(), y[hi:edges[i+2]].mean()
+
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + np.argmax(area)
+        idx[i+1] = a
+
+    return idx
+
+
+def _bucket_extrema(values, buckets):
+    # row positions of the min and max of each column in each bucket
+    df = pd.DataFrame(values)
+    lo = df.fillna(np.inf).groupby(buckets).idxmin()
+    hi = df.fillna(-np.inf).groupby(buckets).idxmax()
+
+    return np.unique(np.concatenate([lo.to_numpy().ravel(),
+                                     hi.to_numpy().ravel()]))
+
+
+def downsample_chunks(chunks, start, stop, n_out=2000, method='minmax'):
+    '''
+    Returns the rows of a series or df, read as a stream of chunks such as
+    from iter_kidata_csv(), that are needed to plot it between start and
+    stop with about n_out points per column. Only one chunk and a handful
+    of carried rows are held in memory at a time.
+
+    Rows are bucketed by time, so gaps in the data stay gaps.
+
+    method: 'minmax' keeps the min and max of each column in each of
+    n_out/2 buckets, so extrema are never lost. 'lttb' keeps the min and
+    max of 2 x n_out buckets and then picks n_out of those with lttb().
+
+    Rows needed by any column are kept for all columns, so this is
+    meant for plotting a few columns at a time.
+    '''
+    start, stop = pd.Timestamp(start), pd.Timestamp(stop)
+    n_buckets = max(n_out // 2, 1) if method == 'minmax' else 2 * n_out
+    width = (stop - start) / n_buckets
+
+    kept, carry = [], None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+
+        buckets = np.floor((chunk.index - start) / width).astype(int)
+        rows = _bucket_extrema(chunk.to_numpy(dtype=np.float64)
+                               .reshape(len(chunk), -1), buckets)
+
+        # the last bucket may continue into the next chunk
+        done = buckets[rows] < buckets.max()
+        kept.append(chunk.iloc[rows[done]])
+        carry = chunk.iloc[rows[~done]]
+
+    if carry is not None:
+        kept.append(carry)
+    if len(kept) == 0:
+        return None
+
+    out = pd.concat(kept)
+
+    if method == 'lttb':
+        values = out.to_numpy(dtype=np.float64).reshape(len(out), -1)
+        x = out.index.asi8 if isinstance(out.index, pd.DatetimeIndex) else out.index
+        rows = []
+        for y in values.T:
+            valid = np.flatnonzero(~np.isnan(y))
+            rows.append(valid[lttb(y[valid], n_out, np.asarray(x)[valid])])
+        out = out.iloc[np.unique(np.concatenate(rows))]
+
+    return out
+
+
+def downsample(data, n_out=2000, method='minmax'):
+    '''
+    Returns the rows of data (a series or df with time index) needed to
+    plot it with about n_out points per column, see downsample_chunks().
+    Unlike resample().mean(), minima and maxima are kept.
+    '''
+    if len(data) <= n_out:
+        return data
+
+    # the end is nudged past the last row so that it lands in the last bucket
+    stop = data.index[-1] + (data.index[-1] - data.index[0]) / (4 * n_out)
+
+    return downsample_chunks([data], data.index[0], stop, n_out, method)
+
+
+# --- Memory-mapped cell matrix: a folder holding values.f32, the raw
+# time-major float32 voltages, with time.npy and cells.npy labelling its
+# rows and columns
+class KiMatrix(namedtuple('KiMatrix', ['values', 'time', 'cells', 'path'],
+                          defaults=[None])):
+    '''
+    Cell voltages as a (time, cell) float32 array with their timestamps
+    and battery positions, see open_matrix().
+
+    It has the index and columns of a df with time index and battery
+    columns, and np.asarray() of it is its values without a copy, so it
+    can be passed to kicluster in place of a df. A memory-mapped matrix
+    pickles as its path, so worker processes map the same file instead of
+    receiving a copy of the data.
+    '''
+    __slots__ = ()
+
+    def __array__(self, dtype=None, copy=None):
+        # a view of the memory map unless a copy is asked for or needed
+        if copy:
+            return np.array(self.values, dtype=dtype, copy=True)
+        if dtype is None or np.dtype(dtype) == self.values.dtype:
+            return np.asarray(self.values)
+        if copy is False:
+            raise ValueError(f'Unable to avoid a copy converting to {dtype}')
+
+        return self.values.astype(dtype)
+
+    @property
+    def index(self):
+        return pd.DatetimeIndex(self.time)
+
+    @property
+    def columns(self):
+        return pd.Index(self.cells)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def frame(self):
+        '''
+        Returns a df with time index and battery columns viewing the values
+        '''
+        return pd.DataFrame(self.values, index=self.index,
+                            columns=self.columns, copy=False)
+
+    def __reduce__(self):
+        if self.path is not None:
+            return (open_matrix, (self.path,))
+        return (KiMatrix, tuple(self))
+
+
+def save_matrix(data, path):
+    '''
+    Writes data to the matrix folder path and returns it memory-mapped.
+
+    data: df with time index and battery columns, or an iterable of them
+    with the same columns, e.g. chunks from iter_kidata_csv(), which are
+    written as they are read
+    '''
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    os.makedirs(path, exist_ok=True)
+
+    times, cells = [], None
+    with open(os.path.join(path, 'values.f32'), 'wb') as f:
+        for chunk in data:
+            if cells is None:
+                cells = chunk.columns
+            elif not chunk.columns.equals(cells):
+                raise ValueError('Chunks have different columns')
+
+            chunk.to_numpy(dtype=np.float32).tofile(f)
+            times.append(pd.DatetimeIndex(chunk.index).to_numpy(dtype='datetime64[ns]'))
+
+    if cells is None:
+        raise ValueError('No data to save')
+
+    np.save(os.path.join(path, 'time.npy'), np.concatenate(times))
+    np.save(os.path.join(path, 'cells.npy'), np.asarray(cells, dtype=str))
+
+    return open_matrix(path)
+
+
+def open_matrix(path, mode='r'):
+    '''
+    Returns the matrix in folder path as a KiMatrix, with its values
+    memory-mapped rather than read. mode is passed to np.memmap.
+    '''
+    time = np.load(os.path.join(path, 'time.npy'))
+    cells = np.load(os.path.join(path, 'cells.npy'))
+    values = np.memmap(os.path.join(path, 'values.f32'), dtype=np.float32,
+                       mode=mode, shape=(len(time), len(cells)))
+
+    return KiMatrix(values, time, cells, path)
+
+
+# --- Per-day, per-string extrema index, saved in CACHE_DIR of each data
+# folder so ranking cells across many days doesn't re-read the day files
+EXTREMA_INDEX = 'extrema index'
+
+
+def summarise_kidata(file, at=()):
+    '''
+    Returns a df with one row per cell of a ki_data file, with the cell's
+    min and max voltage and when they occurred (argmin, argmax).
+
+    at: times of day, e.g. ['22:00'], to also record the voltage at, in
+    columns 'at 22:00'. The nearest sample within 5 minutes is used.
+    '''
+    df = _open_kidata_csv(file, 'date', False, False)
+
+    summary = pd.DataFrame({'min': df.min(), 'max': df.max(),
+                            'argmin': df.idxmin(), 'argmax': df.idxmax()})
+
+    day = pd.Timestamp(parse_kidata_name(file)[1])
+    for t in at:
+        i = df.index.get_indexer([day + pd.Timedelta(f'{t}:00')],
+                                 method='nearest',
+                                 tolerance=pd.Timedelta('5min'))[0]
+        summary[f'at {t}'] = df.iloc[i] if i >= 0 else np.nan
+
+    summary.index.name = 'cell'
+
+    return summary.reset_index()
+
+
+def extrema_index(root='.', at=(), recursive=True):
+    '''
+    Returns the extrema index of every ki_data file under root: the rows of
+    summarise_kidata() for each file, with string, date and file columns.
+
+    The index of each folder is saved in its CACHE_DIR, and only files that
+    are new or modified since it was saved are summarised. Times of day in
+    at are added to those already indexed.
+    '''
+    files = index_kidata(root, recursive)
+    folders = files['file'].map(os.path.dirname)
+
+    parts = [_update_extrema_index(folder, group, at)
+             for folder, group in files.groupby(folders)]
+    if len(parts) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def _update_extrema_index(folder, files, at):
+    path = os.path.join(folder, CACHE_DIR, EXTREMA_INDEX)
+    old = _read_table(path)
+
+    known = [] if old is None else [c[3:] for c in old.columns if c.startswith('at ')]
+    at = sorted(set(known) | set(at))
+    if old is not None and set(at) != set(known):
+        # every file is re-summarised so that each row has every column
+        old = None
+
+    parts, changed = [], old is None
+    for string, date, file in files.itertuples(index=False):
+        name, stat = os.path.basename(file), os.stat(file)
+
+        if old is not None:
+            cached = old[old['file'] == name]
+            if (len(cached) > 0 and cached['mtime'].iat[0] == stat.st_mtime
+                    and cached['size'].iat[0] == stat.st_size):
+                parts.append(cached)
+                continue
+
+        summary = summarise_kidata(file, at)
+        summary.insert(0, 'string', string)
+        summary.insert(1, 'date', date)
+        summary['file'] = name
+        summary['mtime'] = stat.st_mtime
+        summary['size'] = stat.st_size
+        parts.append(summary)
+        changed = True
+
+    index = pd.concat(parts, ignore_index=True)
+
+    # files removed since the index was saved are dropped
+    if changed or len(old) != len(index):
+        _write_table(index, path)
+
+    return index
+
+
+def low_high_cells(index, date, string, num=10, by='min'):
+    '''
+    Returns the num lowest and highest cells of a string on a date from an
+    extrema index, like get_low_high() without reading the day file.
+
+    by: column to rank by, e.g. 'min', 'max' or 'at 22:00'
+    '''
+    day = index[(index['date'] == pd.Timestamp(date).strftime('%Y-%m-%d'))
+                & (index['string'] == string)]
+    ordered = day.dropna(subset=[by]).sort_values(by, kind='stable')['cell']
+
+    return ordered.iloc[:num].tolist(), ordered.iloc[-num:].tolist()
+
+
+def rank_cells(index, by='min'):
+    '''
+    Returns the rank (1 is lowest) of each row of an extrema index among
+    the cells of the same string on the same day, e.g. to count how often
+    each cell is among the lowest across many days
+    '''
+    return index.groupby(['date', 'string'])[by].rank(method='first')
 
 
 # --- Return low/high batteries from a csv file
@@ -0,0 +1,193 @@
+'''
+Windowed dynamic time warping (DTW) distance between time series, for
+clustering profiles that are shifted in time relative to each other.
+
+Rows are individual series, columns are timesteps. DTW costs are squared
+differences and distances are the square root of the warping path cost,
+so they equal the euclidean distance when no warping is allowed.
+
+Pairs are first screened with the LB_Kim and LB_Keogh lower bounds. Given
+a cutoff, pairs whose bound already exceeds it are not computed, and pairs
+whose partial warping cost exceeds it are abandoned early.
+'''
+
+import os
+import concurrent.futures
+
+import numpy as np
+
+
+def envelope(X, window):
+    '''
+    Returns the upper and lower envelopes of each row of X within window
+    '''
+    from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+    size = 2*window + 1
+
+    return (maximum_filter1d(X, size, axis=1, mode='nearest'),
+            minimum_filter1d(X, size, axis=1, mode='nearest'))
+
+
+def lb_kim(x, y):
+    '''
+    Lower bound from the first and last points, which every warping path
+    must match. x and y are (P, T) arrays of pairs.
+    '''
+    return np.sqrt((x[:, 0] - y[:, 0])**2 + (x[:, -1] - y[:, -1])**2)
+
+
+def lb_keogh(x, upper, lower):
+    '''
+    Lower bound from the distance of x to the envelope of the series it is
+    compared to. All arguments are (P, T) arrays of pairs.
+    '''
+    above = np.maximum(x - upper, 0)
+    below = np.maximum(lower - x, 0)
+
+    return np.sqrt(np.einsum('ij,ij->i', above, above)
+                   + np.einsum('ij,ij->i', below, below))
+
+
+def dtw(x, y, window=None, cutoff=None, check_every=32):
+    '''
+    Returns the DTW distance between each pair of rows of x and y, with
+    warping limited to window samples (Sakoe-Chiba band). Default window
+    is None, and allows any warping.
+
+    The cost matrix is filled one anti-diagonal at a time for all pairs
+    at once. Every warping path crosses one of any two consecutive
+    anti-diagonals, so once both exceed cutoff the pair is abandoned and
+    that partial cost is returned as a lower bound.
+    '''
+    # time-major so that each anti-diagonal band is a contiguous block
+    x = np.ascontiguousarray(np.asarray(x, dtype=np.float64).T)
+    y = np.ascontiguousarray(np.asarray(y, dtype=np.float64).T)
+    T, P = x.shape
+    window = T if window is None else window
+    cutoff_sq = np.inf if cutoff is None else cutoff**2
+
+    result = np.empty(P)
+    active = np.arange(P)
+
+    # Path costs on the last two anti-diagonals, indexed by row + 1 so
+    # that row 0 is an out-of-bounds predecessor and always inf
+    prev2 = np.full((T + 1, P), np.inf)
+    prev1 = np.full((T + 1, P), np.inf)
+    prev1[1] = (x[0] - y[0])**2
+    band2, band1 = slice(0, 0), slice(1, 2)
+
+    for s in range(1, 2*T - 1):
+        lo = max(0, s - T + 1, -((window - s) // 2))
+        hi = min(s, T - 1, (s + window) // 2)
+        rows = slice(lo, hi + 1)
+        cols = slice(s - hi, s - lo + 1)
+
+        # predecessors (r, c-1), (r-1, c) and (r-1, c-1) of rows r = lo..hi
+        best = np.minimum(prev1[lo + 1:hi + 2], prev1[rows])
+        np.minimum(best, prev2[rows], out=best)
+
+        cost = x[rows] - y[cols][::-1]
+        np.multiply(cost, cost, out=cost)
+        cost += best
+
+        # reuse the oldest diagonal, clearing its stale band
+        cur = prev2
+        cur[band2] = np.inf
+        cur[lo + 1:hi + 2] = cost
+
+        prev2, prev1 = prev1, cur
+        band2, band1 = band1, slice(lo + 1, hi + 2)
+
+        if cutoff is not None and s % check_every == 0:
+            bound = np.minimum(prev1[band1].min(axis=0),
+                               prev2[band2].min(axis=0))
+            abandon = bound > cutoff_sq
+
+            if abandon.any():
+                result[active[abandon]] = np.sqrt(bound[abandon])
+                keep = ~abandon
+                x, y, active = x[:, keep], y[:, keep], active[keep]
+                prev1, prev2 = prev1[:, keep], prev2[:, keep]
+
+            if len(active) == 0:
+                return result
+
+    result[active] = np.sqrt(prev1[T])
+
+    return result
+
+
+# --- Worker processes hold the series in a global, sent once per process
+_X = None
+
+
+def _init_worker(X):
+    global _X
+    _X = X
+
+
+def _dtw_pairs(rows, cols, window, cutoff):
+    return dtw(_X[rows], _X[cols], window, cutoff)
+
+
+def dtw_pdist(X, window=None, cutoff=None, batch_size=2048, max_workers=None):
+    '''
+    Returns the condensed DTW distance matrix between the rows of X, in
+    pdist order, for use with hac.linkage.
+
+    Parameters
+    ----------
+    window: maximum warping in samples. Default is None, and uses 10% of
+    the series length.
+
+    cutoff: pairs that are provably further apart than cutoff are pruned
+    with lower bounds or abandoned early, and get a lower bound (> cutoff)
+    instead of their exact distance. Single and complete linkage merges
+    below cutoff are unaffected, but other methods average the bounds into
+    their merge heights. Default is None, and computes every distance
+    exactly.
+
+    batch_size: number of pairs computed together
+
+    max_workers: number of worker processes. Default is None, and uses
+    the number of processors. 1 runs in this process.
+    '''
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    N, T = X.shape
+    window = max(1, T // 10) if window is None else window
+
+    rows, cols = np.triu_indices(N, k=1)
+    out = np.empty(len(rows))
+
+    # lower bounds, symmetric in each pair
+    upper, lower = envelope(X, window)
+    for i in range(0, len(rows), batch_size):
+        r, c = rows[i:i+batch_size], cols[i:i+batch_size]
+        out[i:i+batch_size] = np.maximum.reduce([
+            lb_kim(X[r], X[c]),
+            lb_keogh(X[r], upper[c], lower[c]),
+            lb_keogh(X[c], upper[r], lower[r])])
+
+    todo = np.arange(len(rows))
+    if cutoff is not None:
+        todo = todo[out <= cutoff]
+
+    batches = [todo[i:i+batch_size] for i in range(0, len(todo), batch_size)]
+    jobs = ([rows[b] for b in batches], [cols[b] for b in batches],
+            [window] * len(batches), [cutoff] * len(batches))
+
+    if max_workers == 1:
+        _init_worker(X)
+        results = map(_dtw_pairs, *jobs)
+        for b, d in zip(batches, results):
+            out[b] = d
+        return out
+
+    workers = min(max_workers or os.cpu_count(), max(len(batches), 1))
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(X,)) as pool:
+        for b, d in zip(batches, pool.map(_dtw_pairs, *jobs)):
+            out[b] = d
+
+    return out
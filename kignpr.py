@@ -1,78 +1,93 @@
 # Using GNPR to cluster random walks
 # Source code: https://www.datagrapple.com/Tech/GNPR-tutorial-How-to-cluster-random-walks.html
 
-from kidata import mungedata
-import matplotlib.pyplot as plt
 # import pandas as pd
+import time
 import numpy as np
 import scipy
 # from scipy import stats
 # from scipy.stats import mstats
 
-from sklearn.cluster import KMeans
-from sklearn import metrics
+# matplotlib and sklearn are slow to import, so they are imported by the
+# functions that use them
 
 
-def create_random_walks(rho_market, rho_cluster, K, N, T):
-    random_walks = np.zeros((N, T+1))
+def random_walk_labels(K, N):
+    '''
+    Returns the finest class of each series from create_random_walks(),
+    i.e. 2*cluster + 1 for laplace (even rows) or 2*cluster for normal
+    (odd rows) idiosyncratic factors
+    '''
+    n = np.arange(N)
+    cluster_class = np.minimum(n // np.floor(N/K), K-1)
 
-    market_factor = np.random.normal(0, 1, T)
+    return np.where(n % 2, 2*cluster_class, 2*cluster_class+1)
 
-    cluster_factors = np.zeros((K, T))
-    for k in range(0, K):
-        cluster_factors[k, ] = np.random.normal(0, 1, T)
 
-    idiosync_factors = np.zeros((N, T))
-    for n in range(0, N):
-        if n % 2:
-            idiosync_factors[n, ] = np.random.normal(0, 1, T)
-        else:
-            idiosync_factors[n, ] = np.random.laplace(0, 1/np.sqrt(2), T)
+def iter_random_walks(rho_market, rho_cluster, K, N, T, chunk_size=1000,
+                      seed=None):
+    '''
+    Yields the rows of create_random_walks() in chunks of chunk_size series.
 
-    increments = np.zeros((N, T))
-    cluster_class = 0
-    size_class = np.floor(N/K)
+    The market, cluster, normal and laplace factors are drawn from separate
+    streams of one seed, so the walks don't depend on chunk_size.
+    '''
+    streams = np.random.SeedSequence(seed).spawn(3)
+    rng, normal_rng, laplace_rng = [np.random.default_rng(s) for s in streams]
 
-    for n in range(0, N):
+    market_factor = rng.normal(0, 1, T)
+    cluster_factors = rng.normal(0, 1, (K, T))
+    labels = random_walk_labels(K, N)
 
-        market_compo = np.sqrt(rho_market)*market_factor
-        indus_compo = np.sqrt(rho_cluster)*cluster_factors[cluster_class, ]
-        idiosync_compo = np.sqrt(1-rho_market-rho_cluster)*idiosync_factors[n, ]
-        increments[n, ] = market_compo + indus_compo + idiosync_compo
+    for start in range(0, N, chunk_size):
+        n = np.arange(start, min(start + chunk_size, N))
+        odd = n % 2 == 1
 
-        if n % 2:
-            random_walks[n, T] = 2*cluster_class
-        else:
-            random_walks[n, T] = 2*cluster_class+1
+        idiosync_factors = np.empty((len(n), T))
+        idiosync_factors[odd] = normal_rng.normal(0, 1, (odd.sum(), T))
+        idiosync_factors[~odd] = laplace_rng.laplace(0, 1/np.sqrt(2),
+                                                     ((~odd).sum(), T))
 
-        if(((n+1) % size_class == 0) and (cluster_class < K-1)):
-            cluster_class += 1
+        cluster_class = (labels[n] // 2).astype(int)
+        increments = (np.sqrt(rho_market)*market_factor
+                      + np.sqrt(rho_cluster)*cluster_factors[cluster_class]
+                      + np.sqrt(1-rho_market-rho_cluster)*idiosync_factors)
 
-    for n in range(0, N):
-        random_walks[n, 0] = 100
-        for t in range(1, T):
-            random_walks[n, t] = random_walks[n, t-1] + increments[n, t]
+        random_walks = np.empty((len(n), T+1))
+        random_walks[:, 0] = 100
+        random_walks[:, 1:T] = 100 + np.cumsum(increments[:, 1:], axis=1)
+        random_walks[:, T] = labels[n]
 
-    return random_walks
+        yield random_walks
 
 
-rho_market = 0.1
-rho_cluster = 0.1
-K = 3
-N = 12
-T = 10000
+def create_random_walks(rho_market, rho_cluster, K, N, T, seed=None):
+    '''
+    Returns N random walks of length T in K clusters, with the finest class
+    of each walk (see random_walk_labels()) in the last column
+    '''
+    return np.vstack(list(iter_random_walks(rho_market, rho_cluster, K, N, T,
+                                            seed=seed)))
 
-'''
-Note: Rows represent individual series, columns are timesteps
-'''
-random_walks = create_random_walks(rho_market, rho_cluster, K, N, T)
-rdw = random_walks
 
-data = mungedata('30sec data.csv')
-data = np.array(data)
+# --- Benchmark classes of the random walks
+def get_dependence_cl(finest_class):
+    return np.floor(finest_class/2)
+
+
+def get_distribution_cl(finest_class):
+    return finest_class % 2
+
+
+def plotstuff(data, random_walks):
+    '''
+    Plots ki data (e.g. np.array(mungedata('30sec data.csv'))) and random
+    walks from create_random_walks()
+    '''
+    import matplotlib.pyplot as plt
 
+    N, T = random_walks.shape[0], random_walks.shape[1] - 1
 
-def plotstuff():
     # plot ki data
     # fig, ax = plt.subplots(figsize=(20, 10))
     for i in range(0, 50):
@@ -97,94 +112,303 @@ def differentiate(data):
     return dS
 
 
-def get_dependence_repr(data):
-    # N = data.shape[0]
-    # T = data.shape[1]
+def increments(data):
+    '''
+    Returns the increments of each battery of data (a df with time index
+    and battery columns, or a kidata.KiMatrix), one row per battery, for
+    get_gnpr(). A float32 KiMatrix is read in place and gives float32
+    increments.
+    '''
+    values = np.asarray(data)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64, copy=False)
 
-    return scipy.stats.mstats.rankdata(data, 1)
+    return np.diff(values, axis=0).T
 
 
-def get_distribution_repr(data):
+def get_dependence_repr(data):
+    '''
+    Returns the rank of each timestep within its row, with ties averaged,
+    for all rows at once
+    '''
+    return scipy.stats.rankdata(data, axis=1)
+
+
+def get_distribution_repr(data, nbBins=200, bin_range=(-10, 10)):
+    '''
+    Returns the normalised histogram of each row of data, for all rows at
+    once with a single bincount. Bins follow np.histogram, so values outside
+    bin_range are ignored and the last bin includes its right edge.
+    '''
+    data = np.asarray(data, dtype=np.float64)
     N = data.shape[0]
-    # T = data.shape[1]
-    nbBins = 200
-    distribution_repr = np.zeros((N, nbBins))
-    for i in range(0, N):
-        hist, bin_edges = np.histogram(data[i, ],
-                                       bins=nbBins,
-                                       range=(-10, 10),
-                                       density=True)
-        distribution_repr[i, ] = hist*np.diff(bin_edges)
+    lo, hi = bin_range
+    bin_edges = np.linspace(lo, hi, nbBins + 1)
+
+    inside = (data >= lo) & (data <= hi)
+    rows = np.broadcast_to(np.arange(N)[:, None], data.shape)[inside]
+    values = data[inside]
+
+    # same binning (and rounding corrections) as np.histogram
+    bins = ((values - lo) * (nbBins / (hi - lo))).astype(np.intp)
+    bins[bins == nbBins] -= 1
+    bins[values < bin_edges[bins]] -= 1
+    bins[(values >= bin_edges[bins + 1]) & (bins != nbBins - 1)] += 1
+
+    counts = np.bincount(rows * nbBins + bins, minlength=N * nbBins)
+    counts = counts.reshape(N, nbBins).astype(np.float64)
+
+    totals = counts.sum(axis=1, keepdims=True)
+    totals[totals == 0] = np.nan  # as np.histogram with density=True
 
-    return distribution_repr
+    return counts / totals
 
 
-def get_gnpr(data, theta):
-    dependence_repr = get_dependence_repr(data)
-    distribution_repr = get_distribution_repr(data)
+def pairwise_sq_dists(data, chunk_size=None):
+    '''
+    Yields blocks of the condensed (upper triangle) squared euclidean
+    distance matrix between rows of data, in scipy pdist order.
 
+    Uses |x - y|^2 = |x|^2 + |y|^2 - 2x.y so each block is one matrix
+    product. Without a chunk_size all rows are done as a single block,
+    otherwise memory is bounded by chunk_size x N.
+    '''
+    data = np.asarray(data, dtype=np.float64)
     N = data.shape[0]
-    T = data.shape[1]
-    L = dependence_repr.shape[1]+distribution_repr.shape[1]
+    if chunk_size is None:
+        chunk_size = max(N, 1)
 
-    dependence_dist = np.zeros((N, N))
-    distrib_dist = np.zeros((N, N))
-    for i in range(0, N):
-        for j in range(0, N):
-            dependence_dist[i, j] = np.sum(np.power((dependence_repr[i, ] - dependence_repr[j, ]), 2)) / ((1/(3*T))*(T+1)*(T-1))
-            distrib_dist[i, j] = np.sum(np.power((np.sqrt(distribution_repr[i, ]) - np.sqrt(distribution_repr[j, ])), 2)) / 2
+    sq_norms = np.einsum('ij,ij->i', data, data)
 
-    dep_dist_max = dependence_dist.max()
-    distrib_dist_max = distrib_dist.max()
+    for start in range(0, N - 1, chunk_size):
+        stop = min(start + chunk_size, N - 1)
+
+        # rows [start, stop) against every later row
+        gram = data[start:stop] @ data[start:].T
+        block = sq_norms[start:stop, None] + sq_norms[None, start:] - 2*gram
+        np.maximum(block, 0, out=block)
+
+        # keep entries right of the diagonal, row by row
+        rows, cols = np.triu_indices(stop - start, k=1, m=N - start)
+        yield block[rows, cols]
 
-    gnpr = np.zeros((N, L))
-    for i in range(0, N):
-        gnpr[i, 0:T] = dependence_repr[i, ]*np.sqrt(theta)*np.sqrt(3*T)/np.sqrt((T+1)*(T-1)*dep_dist_max)
-        gnpr[i, T:] = np.sqrt(distribution_repr[i, ])*np.sqrt(1-theta)/np.sqrt(2*distrib_dist_max)
+
+def max_sq_dist(data, chunk_size=None):
+    '''
+    Returns the largest pairwise squared euclidean distance between rows
+    of data without holding the full distance matrix.
+    '''
+    dist_max = 0.
+    for block in pairwise_sq_dists(data, chunk_size):
+        if block.size:
+            dist_max = max(dist_max, block.max())
+
+    return dist_max
+
+
+def get_gnpr(data, theta, chunk_size=None, dtype=np.float64):
+    '''
+    Returns the GNPR of each row of data.
+
+    Parameters
+    ----------
+    data: array of increments, rows are series and columns are timesteps
+
+    theta: weight of the dependence part, between 0 and 1
+
+    chunk_size: number of rows per block when computing pairwise distances.
+    Default is None, and computes all pairs in one block.
+
+    dtype: dtype of the returned GNPR, e.g. np.float32 to halve its memory.
+    Distances used for normalisation are always computed in float64.
+    '''
+    return gnpr_from_repr(get_dependence_repr(data),
+                          get_distribution_repr(data),
+                          theta, chunk_size, dtype)
+
+
+def gnpr_from_repr(dependence_repr, distribution_repr, theta,
+                   chunk_size=None, dtype=np.float64):
+    '''
+    Returns the GNPR from the dependence and distribution representations,
+    see get_gnpr()
+    '''
+    sqrt_distrib = np.sqrt(distribution_repr)
+    N, T = dependence_repr.shape
+
+    # only the maxima are needed to normalise the representation
+    dep_dist_max = max_sq_dist(dependence_repr, chunk_size) / ((1/(3*T))*(T+1)*(T-1))
+    distrib_dist_max = max_sq_dist(sqrt_distrib, chunk_size) / 2
+
+    gnpr = np.empty((N, T + sqrt_distrib.shape[1]), dtype=dtype)
+    gnpr[:, :T] = dependence_repr*np.sqrt(theta)*np.sqrt(3*T)/np.sqrt((T+1)*(T-1)*dep_dist_max)
+    gnpr[:, T:] = sqrt_distrib*np.sqrt(1-theta)/np.sqrt(2*distrib_dist_max)
 
     return gnpr
 
 
-# Applying the whole GNPR workflow =========
-rho_market = 0.1
-rho_cluster = 0.1
-K = 3
-N = 120
-T = 10000
-nbDistrib = 2
-nbCluster = nbDistrib*K
-
-# transforming raw data to GNPR
-random_walks = create_random_walks(rho_market, rho_cluster, K, N, T)
-dS = differentiate(random_walks)
-gnpr = get_gnpr(dS, theta=0.5)
-
-kmeans = KMeans(init='k-means++', n_clusters=nbCluster, n_init=50)
-kmeans.fit(gnpr)
-'''
-print("Adjusted Rand Index:",
-      metrics.adjusted_rand_score(random_walks[0:, T], kmeans.labels_))
-'''
-
-# Benchmarking the workflow =========
-def get_dependence_cl(finest_class):
-    return np.floor(finest_class/2)
-def get_distribution_cl(finest_class):
-    return finest_class % 2
+# --- Scalable GNPR: reduced dependence representation and mini-batch KMeans
+def paa(data, segments):
+    '''
+    Piecewise aggregate approximation of each row of data. Segment means
+    are scaled by sqrt(segment length), so distances between the PAA of two
+    rows are a lower bound of their distance.
+    '''
+    T = data.shape[1]
+    bounds = np.linspace(0, T, segments + 1).astype(int)
+    sums = np.add.reduceat(data, bounds[:-1], axis=1)
 
+    return sums / np.sqrt(np.diff(bounds))
 
-parameters = ((nbDistrib, 0, get_distribution_cl(random_walks[0:, T])),
-              (K, 1, get_dependence_cl(random_walks[0:, T])),
-              (nbCluster, 0.5, random_walks[0:, T]))
-parameters
-for nb_cluster, theta, benchmark in parameters:
-    gnpr = get_gnpr(dS, theta)
-    kmeans = KMeans(init='k-means++', n_clusters=nb_cluster, n_init=50)
-    kmeans.fit(gnpr)
-    print("K-Means++ on GNPR:", "theta =", theta, "nb_cluster =", nb_cluster)
-    print(metrics.adjusted_rand_score(benchmark, kmeans.labels_))
-
-    kmeans = KMeans(init='k-means++', n_clusters=nb_cluster, n_init=50)
-    kmeans.fit(dS)
-    print("K-Means++ on dS:", "nb_cluster =", nb_cluster)
-    print(metrics.adjusted_rand_score(benchmark, kmeans.labels_), "\n")
+
+def random_projection(data, n_components, seed=0):
+    '''
+    Projects each row of data onto n_components gaussian random directions,
+    which approximately preserves distances between rows. The directions
+    depend only on seed and the row length, so chunks of rows projected
+    separately are comparable.
+    '''
+    T = data.shape[1]
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(0, 1/np.sqrt(n_components), (T, n_components))
+
+    return data @ directions
+
+
+def approx_gnpr(chunks, theta, reduce='paa', n_components=256, seed=0,
+                chunk_size=None, dtype=np.float32):
+    '''
+    Returns an approximate GNPR, built from chunks of increments (rows are
+    series) so that only one chunk of full-length series is in memory.
+
+    The dependence representation of each chunk is reduced to n_components
+    columns with reduce ('paa' or 'projection') before being kept, so the
+    result is N x (n_components + 200) rather than N x (T + 200).
+    '''
+    reducers = {'paa': lambda x: paa(x, n_components),
+                'projection': lambda x: random_projection(x, n_components, seed)}
+
+    dependence_repr, distribution_repr = [], []
+    for chunk in chunks:
+        dependence_repr.append(reducers[reduce](get_dependence_repr(chunk)))
+        distribution_repr.append(get_distribution_repr(chunk))
+
+    # the GNPR normalisation doesn't depend on the representation length
+    return gnpr_from_repr(np.vstack(dependence_repr),
+                          np.vstack(distribution_repr),
+                          theta, chunk_size, dtype)
+
+
+def iter_batches(data, batch_size, seed=0):
+    '''
+    Yields rows of data in shuffled batches of batch_size
+    '''
+    order = np.random.default_rng(seed).permutation(len(data))
+    for start in range(0, len(data), batch_size):
+        yield data[np.sort(order[start:start + batch_size])]
+
+
+def minibatch_kmeans(gnpr, n_clusters, batch_size=256, epochs=5, seed=0,
+                     init_size=None, n_init=10):
+    '''
+    Fits mini-batch KMeans on the rows of gnpr one batch at a time, and
+    returns the fitted model and the label of each row
+
+    The centres are seeded by full KMeans++ with n_init restarts on a
+    random sample of init_size rows, keeping the restart with the lowest
+    inertia, as a single first batch is too small to seed them reliably.
+    Default init_size is None, and uses 3 batches.
+    '''
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    init_size = 3*max(batch_size, n_clusters) if init_size is None else init_size
+    sample = next(iter_batches(gnpr, min(init_size, len(gnpr)), seed))
+    init = KMeans(n_clusters=n_clusters, init='k-means++', n_init=n_init,
+                  random_state=seed).fit(sample).cluster_centers_
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1,
+                             random_state=seed, batch_size=batch_size)
+
+    for epoch in range(epochs):
+        for batch in iter_batches(gnpr, max(batch_size, n_clusters), seed + epoch):
+            kmeans.partial_fit(batch)
+
+    labels = np.concatenate([kmeans.predict(gnpr[i:i + batch_size])
+                             for i in range(0, len(gnpr), batch_size)])
+
+    return kmeans, labels
+
+
+def compare_approx(dS, benchmark, n_clusters, theta, reduce='paa',
+                   n_components=256, chunk_size=1000, n_init=10):
+    '''
+    Clusters dS with the exact GNPR and KMeans, and with the approximate
+    GNPR and mini-batch KMeans, and returns the ARI of each against
+    benchmark, the ARI lost by approximating and the time taken by each.
+    '''
+    from sklearn.cluster import KMeans
+    from sklearn import metrics
+
+    start = time.perf_counter()
+    kmeans = KMeans(init='k-means++', n_clusters=n_clusters, n_init=n_init)
+    exact = kmeans.fit(get_gnpr(dS, theta)).labels_
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chunks = (dS[i:i + chunk_size] for i in range(0, len(dS), chunk_size))
+    gnpr = approx_gnpr(chunks, theta, reduce, n_components)
+    _, approx = minibatch_kmeans(gnpr, n_clusters)
+    approx_time = time.perf_counter() - start
+
+    exact_ari = metrics.adjusted_rand_score(benchmark, exact)
+    approx_ari = metrics.adjusted_rand_score(benchmark, approx)
+
+    return {'exact ARI': exact_ari,
+            'approx ARI': approx_ari,
+            'ARI loss': exact_ari - approx_ari,
+            'exact vs approx ARI': metrics.adjusted_rand_score(exact, approx),
+            'exact (s)': exact_time,
+            'approx (s)': approx_time}
+
+
+def main():
+    '''
+    Applies the whole GNPR workflow to random walks, and benchmarks
+    K-Means++ on GNPR against K-Means++ on the raw increments
+    '''
+    from sklearn.cluster import KMeans
+    from sklearn import metrics
+
+    # Applying the whole GNPR workflow =========
+    rho_market = 0.1
+    rho_cluster = 0.1
+    K = 3
+    N = 120
+    T = 10000
+    nbDistrib = 2
+    nbCluster = nbDistrib*K
+
+    # transforming raw data to GNPR
+    random_walks = create_random_walks(rho_market, rho_cluster, K, N, T)
+    dS = differentiate(random_walks)
+
+    # Benchmarking the workflow =========
+    parameters = ((nbDistrib, 0, get_distribution_cl(random_walks[0:, T])),
+                  (K, 1, get_dependence_cl(random_walks[0:, T])),
+                  (nbCluster, 0.5, random_walks[0:, T]))
+
+    for nb_cluster, theta, benchmark in parameters:
+        gnpr = get_gnpr(dS, theta)
+        kmeans = KMeans(init='k-means++', n_clusters=nb_cluster, n_init=50)
+        kmeans.fit(gnpr)
+        print("K-Means++ on GNPR:", "theta =", theta, "nb_cluster =", nb_cluster)
+        print(metrics.adjusted_rand_score(benchmark, kmeans.labels_))
+
+        kmeans = KMeans(init='k-means++', n_clusters=nb_cluster, n_init=50)
+        kmeans.fit(dS)
+        print("K-Means++ on dS:", "nb_cluster =", nb_cluster)
+        print(metrics.adjusted_rand_score(benchmark, kmeans.labels_), "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+'''k-Shape clustering of time series using shape-based distance (SBD)
+References:
+Paparrizos & Gravano, k-Shape: Efficient and Accurate Clustering of Time
+Series (papers and journals/fast and accurate time-series clustering.pdf)
+
+Rows are individual series, columns are timesteps.
+'''
+
+import numpy as np
+import scipy.fft as fft
+
+
+def zscore(X, dtype=np.float64):
+    X = np.asarray(X, dtype=dtype)
+    std = X.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+
+    return (X - X.mean(axis=1, keepdims=True)) / std
+
+
+def sbd(X, C):
+    '''
+    Returns the shape-based distance between every row of X and every row
+    of C, and the shift of each row of X that best aligns it to each row
+    of C. Cross-correlations over all shifts are computed with the FFT,
+    so this is O(N.K.T log T).
+
+    Returns
+    -------
+    dists: (N, K) array of 1 - max normalised cross-correlation
+
+    shifts: (N, K) array of shifts, see align()
+    '''
+    N, T = X.shape
+    n = fft.next_fast_len(2*T - 1, real=True)
+
+    FX = fft.rfft(X, n, axis=1)
+    FC = fft.rfft(C, n, axis=1)
+    norms = np.linalg.norm(X, axis=1)[:, None] * np.linalg.norm(C, axis=1)[None, :]
+    norms[norms == 0] = np.inf
+
+    dists = np.empty((N, len(C)))
+    shifts = np.empty((N, len(C)), dtype=int)
+    for k in range(len(C)):
+        # cc[s] = sum_t x[t+s] c[t], with negative shifts wrapped to the end
+        cc = fft.irfft(FX * np.conj(FC[k]), n, axis=1)
+        cc = np.hstack([cc[:, n-T+1:], cc[:, :T]]) / norms[:, [k]]
+
+        best = np.argmax(cc, axis=1)
+        dists[:, k] = 1 - cc[np.arange(N), best]
+        shifts[:, k] = best - (T - 1)
+
+    return dists, shifts
+
+
+def align(X, shifts):
+    '''
+    Shifts each row of X left by its shift, padding with zeros
+    '''
+    T = X.shape[1]
+    idx = np.arange(T)[None, :] + np.asarray(shifts)[:, None]
+    valid = (idx >= 0) & (idx < T)
+
+    return np.where(valid, np.take_along_axis(X, idx.clip(0, T-1), axis=1), 0)
+
+
+def extract_shape(X, centroid):
+    '''
+    Returns the centroid of the rows of X, i.e. the shape maximising the
+    sum of squared normalised cross-correlations to them
+    '''
+    from scipy.sparse.linalg import LinearOperator, eigsh
+
+    if not np.any(centroid):
+        Y = X
+    else:
+        Y = align(X, sbd(X, centroid[None, :])[1][:, 0])
+    Y = zscore(Y)
+    T = Y.shape[1]
+
+    # leading eigenvector of Q'Y'YQ, with Q = I - 1/T, without forming the
+    # T x T matrix
+    def matvec(v):
+        v = v.ravel() - v.mean()
+        v = Y.T @ (Y @ v)
+        return v - v.mean()
+
+    op = LinearOperator((T, T), matvec=matvec, dtype=np.float64)
+    shape = eigsh(op, k=1, which='LA')[1][:, 0]
+
+    # eigenvectors are sign-ambiguous
+    if np.linalg.norm(Y - shape) > np.linalg.norm(Y + shape):
+        shape = -shape
+
+    return zscore(shape[None, :])[0]
+
+
+def kshape(X, k, max_iter=100, seed=None):
+    '''
+    Clusters the rows of X into k clusters with k-Shape.
+
+    Parameters
+    ----------
+    X: (N, T) array of series
+
+    seed: seed for the random initial assignment
+
+    Returns
+    -------
+    labels: cluster of each row, from 0 to k-1
+
+    centroids: (k, T) array of cluster shapes
+    '''
+    X = zscore(X)
+    rng = np.random.default_rng(seed)
+
+    labels = rng.integers(k, size=len(X))
+    centroids = np.zeros((k, X.shape[1]))
+
+    for _ in range(max_iter):
+        for j in range(k):
+            members = X[labels == j]
+            if len(members) == 0:
+                # restart an empty cluster from a random series
+                members = X[[rng.integers(len(X))]]
+            centroids[j] = extract_shape(members, centroids[j])
+
+        new_labels = np.argmin(sbd(X, centroids)[0], axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    return labels, centroids
@@ -0,0 +1,130 @@
+'''
+Partitioned columnar store of the ki_data archive.
+
+ingest() converts per-day, per-string ki_data files into a parquet dataset
+partitioned as site=<site>/string=<string>/date=<YYYY-MM-DD>, with a time
+column and one float32 column per cell. Files are split into row groups of
+row_group_size samples, each with time statistics.
+
+read_store() pushes the time window, string and cell subset down to the
+dataset, so only the day partitions, row groups and cell columns needed
+are read. A refresh crossing midnight reads the end of one day and the
+start of the next:
+
+    kistore.read_store('ki_store', 1, '2019-04-05, 18:00', '2019-04-06, 11:00')
+
+pyarrow is required, and is imported when first used.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import kidata
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('site', pa.string()),
+                                      ('string', pa.int32()),
+                                      ('date', pa.string())]),
+                           flavor='hive')
+
+
+def partition_path(store, site, string, date):
+    '''
+    Returns the folder of one day of one string in the store
+    '''
+    return os.path.join(store, f'site={site}', f'string={string}',
+                        f'date={date}')
+
+
+def ingest(root, store, site='ki', recursive=True, row_group_size=120,
+           overwrite=False):
+    '''
+    Converts every ki_data file under root into the store, and returns the
+    kidata.index_kidata() df of the files that were written.
+
+    Parameters
+    ----------
+    row_group_size: samples per row group, the smallest unit of a time
+    window that is read. Default is 120, i.e. 1 hour of 30 sec data.
+
+    overwrite: rewrite partitions that are newer than their source file.
+    Default is False, so re-running only ingests new or modified files.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    files = kidata.index_kidata(root, recursive)
+
+    written = []
+    for string, date, file in files.itertuples(index=False):
+        folder = partition_path(store, site, string, date)
+        out = os.path.join(folder, 'part-0.parquet')
+
+        if (not overwrite and os.path.exists(out)
+                and os.path.getmtime(out) >= os.path.getmtime(file)):
+            continue
+
+        # empty cells are kept so that every partition has the same columns
+        df = pd.read_csv(file, index_col='date',
+                         usecols=kidata._kidata_usecols())
+        cells = df.to_numpy(dtype=np.float32)
+
+        columns = [pa.array(pd.to_datetime(df.index).to_numpy(dtype='datetime64[ns]'))]
+        columns += [pa.array(cells[:, j]) for j in range(cells.shape[1])]
+        table = pa.table(columns, names=['time', *map(str, df.columns)])
+
+        os.makedirs(folder, exist_ok=True)
+        pq.write_table(table.sort_by('time'), out,
+                       row_group_size=row_group_size, write_statistics=['time'])
+        written.append((string, date, file))
+
+    return pd.DataFrame(written, columns=['string', 'date', 'file'])
+
+
+def read_store(store, string, start=None, stop=None, cells=None, site='ki'):
+    '''
+    Returns a df with time index and battery columns of one string between
+    start and stop, reading only the partitions, row groups and columns
+    needed.
+
+    Parameters
+    ----------
+    start, stop: window bounds, e.g. '2019-03-26, 10:30'. Default is None,
+    and leaves that side open. A string stop includes the whole of its last
+    unit, as in kidata.iter_kidata_csv().
+
+    cells: list of battery positions to read. Default is None, and reads
+    every cell.
+    '''
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(store, format='parquet', partitioning=_partitioning())
+
+    filt = (ds.field('site') == site) & (ds.field('string') == string)
+    if start is not None:
+        start = pd.Timestamp(start)
+        filt &= ds.field('date') >= start.strftime('%Y-%m-%d')
+        filt &= ds.field('time') >= start.to_datetime64()
+    if stop is not None:
+        # end of the period the string resolves to, as partial-string slicing
+        stop = pd.Period(stop).end_time if isinstance(stop, str) \
+            else pd.Timestamp(stop)
+        filt &= ds.field('date') <= stop.strftime('%Y-%m-%d')
+        filt &= ds.field('time') <= stop.to_datetime64()
+
+    if cells is None:
+        partition_keys = {'site', 'string', 'date', 'time'}
+        columns = [c for c in dataset.schema.names if c not in partition_keys]
+    else:
+        columns = [str(c) for c in cells]
+
+    table = dataset.to_table(columns=['time', *columns], filter=filt)
+    df = table.sort_by('time').to_pandas()
+
+    return df.set_index('time').rename_axis('date')
@@ -0,0 +1,87 @@
+'''
+Runs clustering parameter sweeps (filter window x method x metric) over a
+process pool.
+
+The filtered data for each window is written to shared memory once, and
+workers attach to it instead of receiving a pickled copy per job.
+'''
+
+import time
+import itertools
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import kicluster
+
+
+def _share(array):
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[:] = array
+
+    return shm
+
+
+def _run_job(shm_name, shape, dtype, window, method, metric, cut_off):
+    start = time.perf_counter()
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # time index, battery columns
+        data = np.ndarray(shape, dtype, buffer=shm.buf)
+        raw_clusters = kicluster.make_clusters(data, cut_off, method, metric)
+    finally:
+        # release the view before closing the block
+        data = None
+        shm.close()
+
+    sizes = np.bincount(raw_clusters, minlength=cut_off+1)[1:cut_off+1]
+
+    return {'window': window,
+            'method': method,
+            'metric': metric,
+            'cut_off': cut_off,
+            'No. Elements': sizes.tolist(),
+            'Std': sizes.std(ddof=1),
+            'Seconds': time.perf_counter() - start}
+
+
+def run_sweep(data, windows, methods, metrics, cut_off,
+              filt=kicluster.posttrim_savgol, max_workers=None):
+    '''
+    Clusters data for every combination of filter window, linkage method
+    and metric, and returns a df with one row per job.
+
+    Parameters
+    ----------
+    data: df with time index and battery columns
+
+    filt: filter applied to data for each window, called as
+    filt(data, window)
+
+    max_workers: number of worker processes. Default is None, and uses
+    the number of processors.
+    '''
+    shared = []
+    try:
+        jobs = []
+        for window in windows:
+            filtered = np.ascontiguousarray(filt(data, window), dtype=np.float64)
+            shm = _share(filtered)
+            shared.append(shm)
+
+            for method, metric in itertools.product(methods, metrics):
+                jobs.append((shm.name, filtered.shape, filtered.dtype,
+                             window, method, metric, cut_off))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            results = list(pool.map(_run_job, *zip(*jobs)))
+
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    return pd.DataFrame(results)
@@ -21,24 +21,7 @@ import scipy.signal as signal
 import scipy.cluster.hierarchy as hac
 
 import kicluster
-
-
-def posttrim_savgol(data, window=31):
-    '''
-    Applies scipy sav-gol filter then trims output
-    '''
-    timestamps = data.index
-    battnames = data.columns
-
-    # Savitzky-Golay
-    filtered_data = signal.savgol_filter(data, window, 3, axis=0)
-    filtered_data = pd.DataFrame(filtered_data,
-                                 index=timestamps,
-                                 columns=battnames)
-
-    # trim refresh edges to isolate profile
-    trim = filtered_data.iloc[210:-140]
-    return trim
+import kisweep
 
 
 def resamplecomparison(data, factor=10, save_plot=False):
@@ -54,7 +37,7 @@ def resamplecomparison(data, factor=10, save_plot=False):
     n_samples = len(data.index) // factor
 
     # filter then trim
-    pt_savgol = posttrim_savgol(data)
+    pt_savgol = kicluster.posttrim_savgol(data)
 
     # Pandas resample
     pd_resample = data.resample(f'{n_time}Min').mean()
@@ -103,7 +86,7 @@ def dendrogram(data, p=30, save_plot=False):
 
     method = ['single', 'complete', 'average', 'weighted', 'centroid', 'ward']
     for i in method:
-        D = hac.linkage(data.T, method=i, metric='euclidean')
+        D = kicluster.linkage(data, method=i, metric='euclidean')
 
         fig, ax = plt.subplots(figsize=(10, 8))
         hac.dendrogram(D, p=p, truncate_mode='lastp')
@@ -121,31 +104,27 @@ def dendrogram(data, p=30, save_plot=False):
 
         plt.show()
 
-def clustervar(data):
+def clustervar(data, nclusters=12):
     '''Compute cluster size variance based on method
     NOTE: This is broken due to standardising dataframes to have time index
     '''
     filter_window = range(51, 252, 50)
     metrics = ['euclidean']
     method = ['single', 'complete', 'centroid', 'ward']
-    for i in filter_window:
-        filtered_data = posttrim_savgol(data, i)
-
-        for j in method:
-            for k in metrics:
-                sm = kicluster.cluster_summary(filtered_data, nclusters, j, k)
-                print(f"{i}, {j}, {k}, Std: {sm['No. Elements'].std():.2f}")
-                
-                # filtered_data.loc[:, sm['Battery position'][0]].plot(legend=False)
-                # plt.title(f"window: {i}, metric: {j}, method: {k}")
-                # plt.show()
-
-
-# ========== Input parameters ==========
-data = kicluster.cleandata('30sec data.csv')
-nclusters = 12   # dendogram cutoff
-# ========== ================ ==========
-
-dendrogram(data, p=120)
-resamplecomparison(data, factor=20)
-clustervar(data)
+
+    sweep = kisweep.run_sweep(data, filter_window, method, metrics, nclusters,
+                              filt=kicluster.posttrim_savgol)
+    for _, r in sweep.iterrows():
+        print(f"{r['window']}, {r['method']}, {r['metric']}, Std: {r['Std']:.2f}")
+
+
+if __name__ == "__main__":
+    # ========== Input parameters ==========
+    data = kicluster.cleandata('30sec data.csv')
+    nclusters = 12   # dendogram cutoff
+    # ========== ================ ==========
+
+    dendrogram(data, p=120)
+    resamplecomparison(data, factor=20)
+    clustervar(data, nclusters)
+
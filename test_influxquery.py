@@ -0,0 +1,141 @@
+'''
+Tests of the InfluxDB export against local stand-ins for the server.
+
+Run with python -m pytest from this folder.
+'''
+
+import re
+import time
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import influxquery
+
+
+# --- Stub of DataFrameClient: answers a GROUP BY "pos" query with one
+# series per battery, each sampled a few ms later than the last
+class StubClient:
+    def __init__(self, samples=5, delay=0.):
+        self.samples = samples
+        self.delay = delay
+
+    def query(self, db_query):
+        time.sleep(self.delay)
+
+        out = {}
+        for pos in re.findall(r"\"pos\"='(\d+)'", db_query):
+            index = (pd.date_range('2019-05-01', periods=self.samples,
+                                   freq='30s', tz='UTC')
+                     + pd.Timedelta(f'{3*int(pos)}ms'))
+            out[('cell', (('pos', pos),))] = pd.DataFrame(
+                {'Vc': 2 + int(pos)/1000 + np.arange(self.samples)/1e6},
+                index=index)
+
+        return out
+
+
+def test_export_string_aligns_cells():
+    df = influxquery.export_string(StubClient(), 1, '2019-05-01',
+                                   batts=range(1, 5), batch_size=2)
+
+    assert df.shape == (5, 4)
+    assert list(df.columns) == [1, 2, 3, 4]
+    assert df.notna().all().all()
+    assert df.index[0] == pd.Timestamp('2019-05-01 10:00')
+    assert df.index.is_unique
+
+
+def test_export_string_timeout():
+    start = time.perf_counter()
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        influxquery.export_string(StubClient(delay=1.), 1, '2019-05-01',
+                                  batts=range(1, 17), batch_size=2,
+                                  max_workers=2, timeout=0.2)
+
+    # queued batches are cancelled rather than waited for
+    assert time.perf_counter() - start < 1.
+
+
+# --- Fake InfluxDB HTTP server for the asyncio client. Series come back
+# with chunked=true, split over several lines, and the first request for a
+# query containing 'busy' gets a 503.
+@pytest.fixture
+def fake_influx():
+    pytest.importorskip('aiohttp')
+    from aiohttp import web
+    import asyncio
+    import json
+    import threading
+
+    requests = []
+
+    async def handler(request):
+        q = request.query['q']
+        requests.append(q)
+        if 'busy' in q and requests.count(q) == 1:
+            return web.Response(status=503, text='busy')
+
+        chunk_size = int(request.query['chunk_size'])
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+
+        for pos in re.findall(r"\"pos\"='(\d+)'", q):
+            t0 = pd.Timestamp('2019-05-01', tz='UTC').value + 3_000_000*int(pos)
+            values = [[t0 + i*30*10**9, 2 + int(pos)/1000] for i in range(5)]
+
+            for i in range(0, len(values), chunk_size):
+                part = {'name': 'cell', 'tags': {'pos': pos},
+                        'columns': ['time', 'Vc'],
+                        'values': values[i:i+chunk_size], 'partial': True}
+                line = json.dumps({'results': [{'statement_id': 0,
+                                                'series': [part]}]})
+                await resp.write(line.encode() + b'\n')
+
+        await resp.write_eof()
+        return resp
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get('/query', handler)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield influxquery.influx_url('127.0.0.1', port), requests
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_query_many_retries_and_joins_chunks(fake_influx):
+    url, requests = fake_influx
+
+    result, = influxquery.query_many(["busy \"pos\"='1'"], url, user=None,
+                                     chunk_size=2, backoff=0.01)
+
+    assert requests.count("busy \"pos\"='1'") == 2
+    df = result[('cell', (('pos', '1'),))]
+    assert len(df) == 5
+    assert df.index.is_monotonic_increasing
+
+
+def test_export_string_async_aligns_cells(fake_influx):
+    url, _ = fake_influx
+
+    df = influxquery.export_string_async(1, '2019-05-01', batts=range(1, 5),
+                                         batch_size=2, url=url, user=None,
+                                         chunk_size=2)
+
+    assert df.shape == (5, 4)
+    assert df.notna().all().all()
+    assert df.index[0] == pd.Timestamp('2019-05-01 10:00')